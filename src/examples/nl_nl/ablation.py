@@ -0,0 +1,78 @@
+from ...mcfg import CategoryMeta, LexicalBinding, AbsTree, AbsGrammar
+from .span_realization import (Template, Matching, LabeledTree, Realized, MatchingRule, SurfaceRule, Length, UNBOUNDED,
+                               ExhaustOptions, enumerate_trees, iterate_grammar)
+from typing import Iterator, Iterable, TYPE_CHECKING
+from typing import Optional as Maybe
+
+if TYPE_CHECKING:
+    from .tree_cache import TreeCache
+
+
+def rule_mask(tree: AbsTree, grammar: AbsGrammar) -> int:
+    # the ids of the rules used by `tree`, as a bitmask
+    if isinstance(tree, CategoryMeta):
+        return 0
+    root, children = tree
+    mask = 1 << grammar.rule_id(root, tuple(c if isinstance(c, CategoryMeta) else c[0] for c in children))
+    for child in children:
+        mask |= rule_mask(child, grammar)
+    return mask
+
+
+class RuleIndex:
+    # every tree of the full grammar between `min_depth` and `max_depth`, tagged with the rules it uses; the trees of
+    # the grammar without some of its rules are exactly those using none of them, at the same depths
+    def __init__(self, grammar: AbsGrammar, terminal: CategoryMeta, max_depth: int, min_depth: int = 0,
+                 cache: Maybe['TreeCache'] = None, length: Length = UNBOUNDED):
+        self.trees: dict[int, list[AbsTree]] = {}
+        self.masks: dict[int, list[int]] = {}
+        for depth in range(min_depth, max_depth):
+            trees = enumerate_trees(grammar, terminal, depth, length=length) if cache is None else \
+                cache.trees(grammar, terminal, depth, length)
+            self.trees[depth] = list(trees)
+            self.masks[depth] = [rule_mask(tree, grammar) for tree in self.trees[depth]]
+
+    @staticmethod
+    def mask(excluded_rules: Iterable[int]) -> int:
+        return sum(1 << rule for rule in set(excluded_rules))
+
+    def select(self, excluded_rules: Iterable[int]) -> dict[int, list[AbsTree]]:
+        excluded = self.mask(excluded_rules)
+        return {depth: [tree for tree, mask in zip(trees, self.masks[depth]) if not mask & excluded]
+                for depth, trees in self.trees.items()}
+
+    def counts(self, excluded_rules: Iterable[int]) -> dict[int, int]:
+        excluded = self.mask(excluded_rules)
+        return {depth: sum(not mask & excluded for mask in masks) for depth, masks in self.masks.items()}
+
+
+def exhaust_ablations(
+        ablations: Iterable[set[int]],
+        grammar: AbsGrammar,
+        terminal: CategoryMeta,
+        surface_rules: SurfaceRule,
+        matching_rules: MatchingRule,
+        max_depth: int,
+        nouns: set[CategoryMeta],
+        verbs: set[CategoryMeta],
+        sample: Maybe[int] = None,
+        min_depth: int = 0,
+        exclude_candidates: set[CategoryMeta] = frozenset(),
+        *,
+        options: ExhaustOptions = ExhaustOptions(),
+        lexicon: Maybe[LexicalBinding] = None) \
+        -> Iterator[tuple[set[int], Iterator[tuple[int, LabeledTree, Matching, Realized]]]]:
+    # the records of `grammar` without each set of rule ids in `ablations`, as `make_grammar` would build them: the
+    # full grammar is enumerated and its trees compiled once, and each ablation only filters them, keeping the full
+    # grammar's tree order; the rules of `grammar` must be indexed as in the rule lists `ablations` refer to. Every
+    # tree of the index is realized, so `options.tree_sample` is not supported
+    if options.tree_sample is not None:
+        raise ValueError(f'Ablations realize every tree of the index; got tree_sample={options.tree_sample}.')
+    index = RuleIndex(grammar if lexicon is None else grammar.bind(lexicon), terminal, max_depth, min_depth,
+                      options.cache, options.length)
+    templates: dict[AbsTree, Template] = {}
+    for excluded_rules in ablations:
+        yield excluded_rules, iterate_grammar(
+            grammar, terminal, surface_rules, matching_rules, max_depth, nouns, verbs, sample, min_depth,
+            exclude_candidates, options=options, templates=templates, trees=index.select(excluded_rules),
+            lexicon=lexicon)
@@ -109,14 +109,22 @@ Example: Omdat hij de kraanvogels hielp (te) vergiftigen
 """ TODO: Add declarative forms of the embedded clauses, so we can experiment with it. 
 This is only possible with sense verbs, not in general. """
 
-from ...mcfg import CategoryMeta, AbsRule, AbsGrammar
+from ...mcfg import CategoryMeta, AbsRule, AbsGrammar, AbsTree
+from ...mcfg import LexicalBinding
+from typing import Union, TYPE_CHECKING
 from typing import Optional as Maybe
-from .span_realization import exhaust_grammar
+from .span_realization import exhaust_grammar, iterate_grammar, exhaust_configurations, ExhaustOptions, Template
 from .lexicon import Lexicon
+from .ablation import exhaust_ablations
+from .serialization import RecordWriter, encode_surface
 from random import seed as set_seed
 from random import shuffle
+from ast import literal_eval
 import json
 
+if TYPE_CHECKING:
+    from .tokenized import TokenWriter
+
 # Categories
 S = CategoryMeta('S')
 PREF = CategoryMeta('PREF')
@@ -244,25 +252,49 @@ def make_grammar(excluded_rules: set[int]) -> tuple[AbsGrammar, dict[AbsRule, ..
 full_grammar, matching_rules, surf_rules = make_grammar(set())
 
 
+def bind_constants(nouns: list[str], su_verbs_inf: list[str], obj_verbs_inf: list[str],
+                   inf_ivs: list[str], inf_tvs: list[str], ipp_itvs: list[str], ipp_tvs: list[str],
+                   ipp_itvs_te: list[str]) -> LexicalBinding:
+    return LexicalBinding({NP: nouns,
+                           INF_su_ctrl: su_verbs_inf,
+                           INF_obj_ctrl: obj_verbs_inf,
+                           INF_itv: inf_ivs,
+                           INF_tv: [tv for tv in inf_tvs if tv not in ipp_tvs],
+                           IPP_itv: ipp_itvs,
+                           IPP_tv: ipp_tvs,
+                           IPP_itv_te: ipp_itvs_te,
+                           PREF: ['Iemand ziet'],
+                           TE: ['te']})
+
+
 def set_constants(nouns: list[str], su_verbs_inf: list[str], obj_verbs_inf: list[str],
                   inf_ivs: list[str], inf_tvs: list[str], ipp_itvs: list[str], ipp_tvs: list[str],
                   ipp_itvs_te: list[str]):
-    NP.constants = nouns
+    bind_constants(nouns, su_verbs_inf, obj_verbs_inf, inf_ivs, inf_tvs, ipp_itvs, ipp_tvs, ipp_itvs_te).install()
 
-    INF_su_ctrl.constants = su_verbs_inf
-    INF_obj_ctrl.constants = obj_verbs_inf
-    INF_itv.constants = inf_ivs
-    INF_tv.constants = [tv for tv in inf_tvs if tv not in ipp_tvs]
-    IPP_itv.constants = ipp_itvs
-    IPP_tv.constants = ipp_tvs
-    IPP_itv_te.constants = ipp_itvs_te
-    PREF.constants = ['Iemand ziet']
-    TE.constants = ['te']
 
-
-def get_grammar(max_depth: int, sample: Maybe[int], min_depth: int = 0, grammar: AbsGrammar = full_grammar):
+def get_grammar(max_depth: int, sample: Maybe[int], min_depth: int = 0, grammar: AbsGrammar = full_grammar,
+                tree_sample: Maybe[int] = None, templates: Maybe[dict[AbsTree, Template]] = None,
+                batched: bool = False, workers: Maybe[int] = None, seed: Maybe[int] = None):
     return exhaust_grammar(grammar, S, surf_rules, matching_rules, max_depth, n_candidates,
-                           v_candidates, sample, min_depth, exclude_candidates)
+                           v_candidates, sample, min_depth, exclude_candidates,
+                           options=ExhaustOptions(tree_sample=tree_sample, batched=batched, workers=workers, seed=seed),
+                           templates=templates)
+
+
+def iterate_records(max_depth: int, sample: Maybe[int], min_depth: int = 0, grammar: AbsGrammar = full_grammar,
+                    tree_sample: Maybe[int] = None, workers: Maybe[int] = None, seed: Maybe[int] = None):
+    return iterate_grammar(grammar, S, surf_rules, matching_rules, max_depth, n_candidates, v_candidates,
+                           sample, min_depth, exclude_candidates,
+                           options=ExhaustOptions(tree_sample=tree_sample, workers=workers, seed=seed))
+
+
+def iterate_ablations(ablations: list[set[int]], max_depth: int, sample: Maybe[int], min_depth: int = 0,
+                      workers: Maybe[int] = None, seed: Maybe[int] = None):
+    # the records of `make_grammar(excluded_rules)` for each set of excluded rules, from a single enumeration
+    return exhaust_ablations(ablations, full_grammar, S, surf_rules, matching_rules, max_depth, n_candidates,
+                             v_candidates, sample, min_depth, exclude_candidates,
+                             options=ExhaustOptions(workers=workers, seed=seed))
 
 
 def setup_grammar():
@@ -301,15 +333,16 @@ def setup_grammar():
                   ipp_tvs=ipp_tvs,
                   ipp_itvs_te=ipp_itvs_te)
     grammar = full_grammar
-    results = {depth: {str(tree): (matching, [str(surf) for surf in surfaces])
+    results = {depth: {str(tree): (matching, [encode_surface(surf) for surf in surfaces])
                for tree, (matching, surfaces) in trees.items()}
                for depth, trees in get_grammar(max_depth, num_samples, min_depth=min_depth,
                grammar=grammar).items()}
     return grammar, results
 
 
-def extract_sentence(inp: str) -> str:
-    return ' '.join([i[2] for i in eval(inp)])
+def extract_sentence(inp: Union[str, list[list]]) -> str:
+    # older result files hold the repr of the realization rather than its encoded spans
+    return ' '.join(word for _, _, word in (literal_eval(inp) if isinstance(inp, str) else inp))
 
 
 def extract_sentences(results: dict) -> list[str]:
@@ -324,41 +357,52 @@ def main(gen_file: str):
     with open(gen_file, 'r') as f:
         experiment = json.load(f)['cluster']
 
-    all_nouns = Lexicon.de_nouns()
-    su_verbs_inf = Lexicon.sub_control_verbs_inf()
-    obj_verbs_inf = Lexicon.obj_control_verbs_inf()
-    inf_ivs = Lexicon.infinitive_verbs()
-    inf_tvs = Lexicon.vos()
-    ipp_itvs = Lexicon.ipp_itvs()
-    ipp_tvs = Lexicon.ipp_tvs()
-    ipp_itvs_te = Lexicon.ipp_itvs_te()
-
-    seed = experiment["seed"]
-    set_seed(seed)
-    shuffle(all_nouns)
-    shuffle(su_verbs_inf)
-    shuffle(obj_verbs_inf)
-    shuffle(inf_ivs)
-    shuffle(inf_tvs)
-    shuffle(ipp_itvs)
-    shuffle(ipp_tvs)
-    shuffle(ipp_itvs_te)
+    lexicon = dict(nouns=Lexicon.de_nouns(),
+                   su_verbs_inf=Lexicon.sub_control_verbs_inf(),
+                   obj_verbs_inf=Lexicon.obj_control_verbs_inf(),
+                   inf_ivs=Lexicon.infinitive_verbs(),
+                   inf_tvs=Lexicon.vos(),
+                   ipp_itvs=Lexicon.ipp_itvs(),
+                   ipp_tvs=Lexicon.ipp_tvs(),
+                   ipp_itvs_te=Lexicon.ipp_itvs_te())
+
+    def configure(seed: int) -> LexicalBinding:
+        # a fresh shuffle of the lexicon per seed, in the same order as a single-seed run
+        set_seed(seed)
+        shuffled = {category: list(words) for category, words in lexicon.items()}
+        for words in shuffled.values():
+            shuffle(words)
+        return bind_constants(**shuffled)
+
+    def open_writer(seed: int) -> Union['TokenWriter', RecordWriter]:
+        # token writers (and the tree cache) need numpy, which plain JSONL runs do without
+        if experiment.get('format') == 'tokens':
+            from .tokenized import TokenWriter
+            return TokenWriter(f'./grammars/cluster_{seed}')
+        return RecordWriter(f'./grammars/cluster_{seed}', full_grammar.categories,
+                            experiment.get('shard_size', 1 << 28), experiment.get('compression'))
 
     min_depth, max_depth = experiment['depth']
     num_samples = experiment['samples']
-
-    set_constants(nouns=all_nouns,
-                  su_verbs_inf=su_verbs_inf,
-                  obj_verbs_inf=obj_verbs_inf,
-                  inf_ivs=inf_ivs,
-                  inf_tvs=inf_tvs,
-                  ipp_itvs=ipp_itvs,
-                  ipp_tvs=ipp_tvs,
-                  ipp_itvs_te=ipp_itvs_te)
-
-    result = {depth: {str(tree): (matching, [str(surf) for surf in surfaces])
-                      for tree, (matching, surfaces) in trees.items()}
-              for depth, trees in get_grammar(max_depth, num_samples,
-                                              min_depth=min_depth, grammar=full_grammar).items()}
-    with open(f'./grammars/cluster_{seed}.json', 'w') as out_file:
-        json.dump(result, out_file, indent=4)
+    num_trees = experiment.get('trees')
+    num_workers = experiment.get('workers')
+    cache = None
+    if 'cache' in experiment:
+        from .tree_cache import TreeCache
+        cache = TreeCache(experiment['cache'], experiment.get('cache_size', 1 << 30))
+    min_length, max_length = experiment.get('length', [0, None])
+    tokens = experiment.get('length_unit', 'leaves') == 'tokens'
+    seeds = experiment.get('seeds', [experiment.get('seed')])
+    options = ExhaustOptions(tree_sample=num_trees, length=(min_length, max_length, tokens), cache=cache,
+                             batched=num_samples is None, workers=num_workers)
+
+    # trees are enumerated and compiled once, and realized against each seed's lexicon in turn; exhaustive
+    # realizations are built in batches, which token writers lay out without decoding them. Each seed also seeds the
+    # samples of its records, so that they are the same with or without workers
+    for seed, records in exhaust_configurations(configure, seeds, full_grammar, S, surf_rules, matching_rules,
+                                                max_depth, n_candidates, v_candidates, num_samples, min_depth,
+                                                exclude_candidates, options=options, seeds=lambda seed: seed,
+                                                per_tree=True):
+        with open_writer(seed) as writer:
+            for depth, tree, matching, surfaces in records:
+                writer.write_records(depth, tree, matching, surfaces)
@@ -0,0 +1,107 @@
+"""
+Records are JSON lines of nested lists of ints and strings; categories are stored as indices into the string table
+that heads every file.
+
+    {"categories": ["CTRL", "NP_s", ...]}
+    {"depth": 3, "tree": [null, null, 0, [[0, null, 1, [...]], ...]], "matching": [[0, 0], [1, 0]],
+     "surface": [[[0], [], "de man"], [[], [0], "belooft"], ...]}
+
+A labeled node (np, vp, category) with children is written as [np, vp, category id, [children]], with an empty
+children list for leaves; a matching as a list of [verb, noun] pairs; a realization as its [nps, vps, word] spans.
+"""
+
+from ...mcfg import CategoryMeta, Tree
+from .span_realization import LabeledTree, Matching, Realized
+from .shards import ShardWriter
+from typing import IO, Iterator, Iterable, Any
+from typing import Optional as Maybe
+import gzip
+import io
+import json
+
+EncodedTree = list
+Record = tuple[int, LabeledTree, Matching, Realized]
+
+
+def encode_tree(tree: LabeledTree, ids: dict[CategoryMeta, int]) -> EncodedTree:
+    if len(tree) == 3:
+        np_idx, vp_idx, category = tree
+        return [np_idx, vp_idx, ids[category], []]
+    (np_idx, vp_idx, category), children = tree
+    return [np_idx, vp_idx, ids[category], [encode_tree(child, ids) for child in children]]
+
+
+def decode_tree(data: EncodedTree, names: list[str]) -> Tree[tuple[Maybe[int], Maybe[int], str]]:
+    np_idx, vp_idx, category, children = data
+    if not children:
+        return np_idx, vp_idx, names[category]
+    return (np_idx, vp_idx, names[category]), tuple(decode_tree(child, names) for child in children)
+
+
+def encode_matching(matching: Matching) -> list[list[int]]:
+    return [[k, v] for k, v in matching.items()]
+
+
+def decode_matching(data: list[list[int]]) -> Matching:
+    return {k: v for k, v in data}
+
+
+def encode_surface(realized: Realized) -> list[list]:
+    return [[nps, vps, word] for nps, vps, word in realized]
+
+
+def decode_surface(data: list[list]) -> Realized:
+    return [(nps, vps, word) for nps, vps, word in data]
+
+
+class RecordWriter(ShardWriter):
+    def __init__(self, prefix: str, categories: list[CategoryMeta], max_bytes: int = 1 << 28,
+                 compression: Maybe[str] = None):
+        super().__init__(prefix, max_bytes, compression, header={'categories': list(map(str, categories))})
+        self.ids = {c: idx for idx, c in enumerate(categories)}
+
+    def write_record(self, depth: int, tree: LabeledTree, matching: Matching, realized: Realized) -> None:
+        self.write(depth, {'depth': depth,
+                           'tree': encode_tree(tree, self.ids),
+                           'matching': encode_matching(matching),
+                           'surface': encode_surface(realized)})
+
+    def write_records(self, depth: int, tree: LabeledTree, matching: Matching, surfaces: Iterable[Realized]) -> None:
+        for realized in surfaces:
+            self.write_record(depth, tree, matching, realized)
+
+
+def open_lines(path: str) -> IO[str]:
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8')
+    if path.endswith('.zst'):
+        import zstandard
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True),
+                                encoding='utf-8')
+    return open(path, 'r', encoding='utf-8')
+
+
+def read_raw(path: str) -> Iterator[tuple[list[str], dict[str, Any]]]:
+    # the category table and each undecoded record, one line at a time
+    with open_lines(path) as f:
+        names = json.loads(next(f))['categories']
+        for line in f:
+            yield names, json.loads(line)
+
+
+def read_records(path: str) -> Iterator[Record]:
+    for names, record in read_raw(path):
+        yield (record['depth'], decode_tree(record['tree'], names), decode_matching(record['matching']),
+               decode_surface(record['surface']))
+
+
+def read_sentences(path: str) -> Iterator[str]:
+    return (' '.join(word for _, _, word in record['surface']) for _, record in read_raw(path))
+
+
+def read_labels(path: str) -> Iterator[list[tuple[list[int], list[int]]]]:
+    return ([(nps, vps) for nps, vps, _ in record['surface']] for _, record in read_raw(path))
+
+
+def read_matchings(path: str) -> Iterator[Matching]:
+    return (decode_matching(record['matching']) for _, record in read_raw(path))
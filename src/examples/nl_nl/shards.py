@@ -0,0 +1,66 @@
+from typing import IO, Iterable, Any
+from typing import Optional as Maybe
+import gzip
+import json
+
+
+def open_shard(path: str, compression: Maybe[str]) -> IO[bytes]:
+    if compression is None:
+        return open(path, 'wb')
+    if compression == 'gzip':
+        return gzip.open(path, 'wb')
+    if compression == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor().stream_writer(open(path, 'wb'), closefd=True)
+    raise ValueError(f'Unknown compression {compression}.')
+
+
+class ShardWriter:
+    # one JSON record per line, rolling over to a new file per depth whenever a shard reaches `max_bytes`
+    # (counted before compression); every shard starts with the `header` record, if any
+    extensions = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+
+    def __init__(self, prefix: str, max_bytes: int = 1 << 28, compression: Maybe[str] = None,
+                 header: Maybe[Any] = None):
+        if compression not in self.extensions:
+            raise ValueError(f'Unknown compression {compression}.')
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.compression = compression
+        self.header = None if header is None else (json.dumps(header) + '\n').encode('utf-8')
+        self.files: dict[int, tuple[IO[bytes], int]] = {}
+        self.shards: dict[int, int] = {}
+        self.paths: list[str] = []
+
+    def path(self, depth: int, shard: int) -> str:
+        return f'{self.prefix}_{depth}_{shard:04d}.jsonl{self.extensions[self.compression]}'
+
+    def write(self, depth: int, record: Any) -> None:
+        line = (json.dumps(record) + '\n').encode('utf-8')
+        file, size = self.files.get(depth, (None, 0))
+        if file is None or size + len(line) > self.max_bytes and size > 0:
+            if file is not None:
+                file.close()
+            self.shards[depth] = shard = self.shards.get(depth, -1) + 1
+            self.paths.append(self.path(depth, shard))
+            file, size = open_shard(self.paths[-1], self.compression), 0
+            if self.header is not None:
+                file.write(self.header)
+                size += len(self.header)
+        file.write(line)
+        self.files[depth] = file, size + len(line)
+
+    def write_all(self, records: Iterable[tuple[int, Any]]) -> None:
+        for depth, record in records:
+            self.write(depth, record)
+
+    def close(self) -> None:
+        for file, _ in self.files.values():
+            file.close()
+        self.files.clear()
+
+    def __enter__(self) -> 'ShardWriter':
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
@@ -0,0 +1,120 @@
+from ...mcfg import CategoryMeta, LexicalBinding
+from .span_realization import SpanRealization, Realized, Length, UNBOUNDED
+from typing import Iterator
+from typing import Optional as Maybe
+import numpy as np
+from numpy.typing import NDArray
+
+
+class Vocabulary:
+    # NumPy views of a lexicon's word id tables, and the word array to decode them with
+    def __init__(self, lexicon: Maybe[LexicalBinding] = None):
+        self.lexicon = LexicalBinding() if lexicon is None else lexicon
+        self.word_array: NDArray[np.object_] = np.array([], dtype=object)
+        self.token_counts: NDArray[np.int64] = np.zeros(0, dtype=np.int64)
+
+    def table(self, category: CategoryMeta) -> NDArray[np.int64]:
+        # (len(constants), arity) matrix of token ids
+        return np.frombuffer(self.lexicon.ids(category), dtype=np.int64).reshape(-1, category.arity)
+
+    def decode(self, ids: NDArray[np.int64]) -> list[list[str]]:
+        if len(self.word_array) != len(self.lexicon.words):
+            self.word_array = np.array(self.lexicon.words, dtype=object)
+        return self.word_array[ids].tolist()
+
+    def count_tokens(self, ids: NDArray[np.int64]) -> NDArray[np.int64]:
+        # the number of whitespace-separated tokens of each row
+        if len(self.token_counts) != len(self.lexicon.words):
+            self.token_counts = np.array([len(word.split()) for word in self.lexicon.words], dtype=np.int64)
+        return self.token_counts[ids].sum(axis=1)
+
+
+def extend_block(ids: NDArray[np.int64], table: NDArray[np.int64], columns: NDArray[np.int64],
+                 coords: NDArray[np.int64]) -> NDArray[np.int64]:
+    # the cross product of a block of partial realizations with every constant of the next leaf, in product order
+    rows = np.repeat(ids, len(table), axis=0)
+    rows[:, columns] = np.tile(table, (len(ids), 1))[:, coords]
+    return rows
+
+
+def valid_rows(rows: NDArray[np.int64], columns: NDArray[np.int64], neighbours: list[list[int]],
+               others: list[list[int]]) -> NDArray[np.bool_]:
+    # adjacent spans must differ, as must the new non-excluded spans from the ones placed before them
+    keep = np.ones(len(rows), dtype=bool)
+    for p, adjacent, distinct in zip(columns, neighbours, others):
+        for q in adjacent:
+            keep &= rows[:, p] != rows[:, q]
+        if distinct:
+            keep &= (rows[:, distinct] != rows[:, [p]]).all(axis=1)
+    return keep
+
+
+def get_choice_ids(
+        leaves: list[CategoryMeta],
+        realization: SpanRealization,
+        vocabulary: Vocabulary,
+        exclude: set[CategoryMeta] = frozenset(),
+        block_size: int = 1 << 16) -> Iterator[NDArray[np.int64]]:
+    # vectorized backtracking: partial assignments are extended one leaf at a time, a block of rows at a time
+    tables = [vocabulary.table(leaf) for leaf in leaves]
+    owners = np.array([idx for _, _, (idx, _) in realization], dtype=np.int64)
+    coords = np.array([coord for _, _, (_, coord) in realization], dtype=np.int64)
+    distinct = np.array([leaves[idx] not in exclude for idx in owners], dtype=bool)
+    columns = [np.flatnonzero(owners == i) for i in range(len(leaves))]
+    neighbours = [[[q for q in (p - 1, p + 1) if 0 <= q < len(owners) and owners[q] <= i] for p in columns[i]]
+                  for i in range(len(leaves))]
+    others = [[[q for q in np.flatnonzero(distinct & (owners <= i)) if q != p] if distinct[p] else []
+               for p in columns[i]] for i in range(len(leaves))]
+
+    def extend(ids: NDArray[np.int64], i: int) -> Iterator[NDArray[np.int64]]:
+        if i == len(leaves):
+            if len(ids):
+                yield ids
+            return
+        step = max(1, block_size // max(1, len(tables[i])))
+        for start in range(0, len(ids), step):
+            rows = extend_block(ids[start:start + step], tables[i], columns[i], coords[columns[i]])
+            yield from extend(rows[valid_rows(rows, columns[i], neighbours[i], others[i])], i + 1)
+    return extend(np.zeros((1, len(owners)), dtype=np.int64), 0)
+
+
+class ChoiceBlocks:
+    # the realizations of one tree as blocks of word id rows, one column per span, decoded to strings only when
+    # iterated; writers that work on ids read `blocks` instead, and either way they are consumed once
+    def __init__(self, blocks: Iterator[NDArray[np.int64]], realization: SpanRealization, vocabulary: Vocabulary):
+        self.blocks = blocks
+        self.np_labels = [nps for nps, _, _ in realization]
+        self.vp_labels = [vps for _, vps, _ in realization]
+        self.vocabulary = vocabulary
+        self.decoded = (list(zip(self.np_labels, self.vp_labels, strs))
+                        for ids in blocks for strs in vocabulary.decode(ids))
+
+    def __iter__(self) -> 'ChoiceBlocks':
+        return self
+
+    def __next__(self) -> Realized:
+        return next(self.decoded)
+
+
+def within_rows(ids: NDArray[np.int64], vocabulary: Vocabulary, length: Length) -> NDArray[np.int64]:
+    min_length, max_length, _ = length
+    counts = vocabulary.count_tokens(ids)
+    keep = counts >= min_length
+    if max_length is not None:
+        keep &= counts <= max_length
+    return ids[keep]
+
+
+def get_choices_batched(
+        leaves: list[CategoryMeta],
+        realization: SpanRealization,
+        exclude: set[CategoryMeta] = frozenset(),
+        vocabulary: Maybe[Vocabulary] = None,
+        block_size: int = 1 << 16,
+        length: Length = UNBOUNDED) -> ChoiceBlocks:
+    # with a window on tokens, rows realized with more or fewer tokens than it allows are dropped
+    vocabulary = Vocabulary() if vocabulary is None else vocabulary
+    blocks = get_choice_ids(leaves, realization, vocabulary, exclude, block_size)
+    if length[2]:
+        blocks = (rows for ids in blocks if len(rows := within_rows(ids, vocabulary, length)))
+    return ChoiceBlocks(blocks, realization, vocabulary)
@@ -0,0 +1,130 @@
+from ...mcfg import CategoryMeta, LexicalBinding, AbsTree, AbsGrammar, CompiledGrammar, Tree, map_tree
+from .span_realization import (LabeledTree, Matching, Realized, RuleTable, Length, UNBOUNDED, compile_tree,
+                               realize_template)
+from typing import Iterator, Callable, TYPE_CHECKING
+from typing import Optional as Maybe
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from itertools import islice, chain
+from collections import deque
+from random import Random
+
+if TYPE_CHECKING:
+    from .span_batching import Vocabulary
+
+Constants = tuple[tuple[tuple[str, ...], ...], ...]
+IdTree = Tree[tuple[Maybe[int], Maybe[int], int]]
+
+
+@dataclass
+class Worker:
+    categories:         list[CategoryMeta]
+    rules:              RuleTable
+    nouns:              set[CategoryMeta]
+    verbs:              set[CategoryMeta]
+    exclude_candidates: set[CategoryMeta]
+    sample:             Maybe[int]
+    lexicon:            LexicalBinding
+    vocabulary:         Maybe['Vocabulary']
+    length:             Length
+
+
+worker: Maybe[Worker] = None
+
+
+def restore(compiled: CompiledGrammar, constants: Constants) \
+        -> tuple[list[CategoryMeta], LexicalBinding, RuleTable]:
+    # fresh categories and rules for this process, rebuilt from the integer tables of the parent's grammar
+    categories = [CategoryMeta(name, arity) for name, arity in zip(compiled.names, compiled.arities)]
+    lexicon = LexicalBinding({category: [s[0] for s in surfaces] if category.arity == 1 else list(surfaces)
+                              for category, surfaces in zip(categories, constants)})
+    rules = RuleTable(ids={(categories[compiled.lhs[r]], tuple(categories[c] for c in compiled.rule_rhs(r))): r
+                           for r in range(len(compiled))},
+                      linearizations=[compiled.linearization(r) for r in range(len(compiled))],
+                      annotations=[compiled.annotation(r) for r in range(len(compiled))])
+    return categories, lexicon, rules
+
+
+def init_worker(compiled: CompiledGrammar, constants: Constants, nouns: set[int], verbs: set[int],
+                exclude_candidates: set[int], sample: Maybe[int], batched: bool, length: Length) -> None:
+    global worker
+    categories, lexicon, rules = restore(compiled, constants)
+    vocabulary = None
+    if batched:
+        from .span_batching import Vocabulary
+        vocabulary = Vocabulary(lexicon)
+    worker = Worker(categories=categories,
+                    rules=rules,
+                    nouns={categories[c] for c in nouns},
+                    verbs={categories[c] for c in verbs},
+                    exclude_candidates={categories[c] for c in exclude_candidates},
+                    sample=sample,
+                    lexicon=lexicon,
+                    vocabulary=vocabulary,
+                    length=length)
+
+
+def from_ids(tree: Tree[int], categories: list[CategoryMeta]) -> AbsTree:
+    if isinstance(tree, int):
+        return categories[tree]
+    head, children = tree
+    return categories[head], tuple(map(lambda c: from_ids(c, categories), children))
+
+
+def map_labeled(tree: LabeledTree, f: Callable) -> LabeledTree:
+    if len(tree) == 3:
+        np_idx, vp_idx, category = tree
+        return np_idx, vp_idx, f(category)
+    head, children = tree
+    return map_labeled(head, f), tuple(map(lambda c: map_labeled(c, f), children))
+
+
+def realize_chunk(seed: str, trees: list[Tree[int]]) -> list[tuple[IdTree, Matching, list[Realized]]]:
+    rng, ids = Random(seed), {c: idx for idx, c in enumerate(worker.categories)}
+    ret = []
+    for tree in trees:
+        template = compile_tree(from_ids(tree, worker.categories), worker.rules, worker.nouns, worker.verbs)
+        surfaces = list(realize_template(template, worker.sample, worker.exclude_candidates, worker.vocabulary, rng,
+                                         worker.lexicon, worker.length))
+        ret.append((map_labeled(template.labeled_tree, ids.__getitem__), template.matching, surfaces))
+    return ret
+
+
+def chunked(trees: Iterator[AbsTree], chunk_size: int) -> Iterator[list[AbsTree]]:
+    while chunk := list(islice(trees, chunk_size)):
+        yield chunk
+
+
+def exhaust_parallel(
+        grammar: AbsGrammar,
+        compiled: CompiledGrammar,
+        trees: Iterator[tuple[int, Iterator[AbsTree]]],
+        nouns: set[CategoryMeta],
+        verbs: set[CategoryMeta],
+        sample: Maybe[int],
+        exclude_candidates: set[CategoryMeta],
+        batched: bool,
+        workers: int,
+        chunk_size: int,
+        seed: int,
+        lexicon: Maybe[LexicalBinding] = None,
+        length: Length = UNBOUNDED) -> Iterator[tuple[int, LabeledTree, Matching, list[Realized]]]:
+    # the grammar and lexicon are shipped once per process; chunks go out as trees of category ids, with at most
+    # `2 * workers` of them in flight, so that memory stays bounded regardless of the number of trees
+    ids = grammar.category_ids
+    lexicon = LexicalBinding() if lexicon is None else lexicon
+    constants = tuple(tuple(c.surface for c in lexicon.constants(category)) for category in grammar.categories)
+    jobs = ((depth, f'{seed}:{depth}:{k}', [map_tree(tree, ids.__getitem__) for tree in chunk])
+            for depth, depth_trees in trees for k, chunk in enumerate(chunked(depth_trees, chunk_size)))
+    initargs = (compiled, constants, {ids[c] for c in nouns if c in ids}, {ids[c] for c in verbs if c in ids},
+                {ids[c] for c in exclude_candidates if c in ids}, sample, batched, length)
+    with ProcessPoolExecutor(workers, initializer=init_worker, initargs=initargs) as executor:
+        pending = deque()
+        for job in chain(jobs, [None]):
+            if job is not None:
+                depth, chunk_seed, chunk = job
+                pending.append((depth, executor.submit(realize_chunk, chunk_seed, chunk)))
+            while pending and (job is None or len(pending) > 2 * workers):
+                depth, future = pending.popleft()
+                for labeled_tree, matching, surfaces in future.result():
+                    yield depth, map_labeled(labeled_tree, grammar.categories.__getitem__), matching, surfaces
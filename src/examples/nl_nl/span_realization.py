@@ -1,9 +1,17 @@
-from ...mcfg import Category, CategoryMeta, Tree, AbsTree, AbsRule, AbsGrammar
-from typing import Union, Iterator, Sequence
+from ...mcfg import (Category, CategoryMeta, LexicalBinding, T, Tree, AbsTree, AbsRule, AbsGrammar, Node, Linearization,
+                     Annotation, Extent, to_node)
+from typing import Union, Iterator, Iterable, Sequence, Callable, TYPE_CHECKING
 from typing import Optional as Maybe
-from random import choice as choose
+from random import Random
+from warnings import warn
+import random
 from operator import eq
-from itertools import product
+from itertools import accumulate
+from dataclasses import dataclass, replace
+
+if TYPE_CHECKING:
+    from .span_batching import Vocabulary
+    from .tree_cache import TreeCache
 
 LabeledNode = tuple[Maybe[int], Maybe[int],  CategoryMeta]
 LabeledTree = Tree[LabeledNode]
@@ -12,6 +20,10 @@ MatchingRule = dict[AbsRule, tuple[dict[int, Maybe[int]], tuple[Union[bool, int]
 SurfaceRule = dict[AbsRule, tuple[list[tuple[int, int]], ...]]
 SpanRealization = list[tuple[list[int], list[int], tuple[int, int]]]
 Realized = list[tuple[list[int], list[int], str]]
+Rope = list[Union[tuple[list[int], list[int], tuple[int, int]], 'Rope']]
+Length = tuple[int, Maybe[int], bool]
+
+UNBOUNDED: Length = (0, None, False)
 
 
 def abstree_to_labeledtree(tree: AbsTree, n_candidates: set[CategoryMeta], v_candidates: set[CategoryMeta],
@@ -36,17 +48,48 @@ def get_top(_tree: LabeledTree) -> LabeledNode:
     return _tree if len(_tree) == 3 else _tree[0]
 
 
+@dataclass(frozen=True)
+class RuleTable:
+    # surface and matching rules as lists indexed by rule id: each node costs one (lhs, rhs) lookup of its id
+    ids:            dict[tuple[CategoryMeta, tuple[CategoryMeta, ...]], int]
+    linearizations: list[Maybe[Linearization]]
+    annotations:    list[Maybe[Annotation]]
+
+    def rule_id(self, category: CategoryMeta, children: tuple[LabeledTree, ...]) -> int:
+        return self.ids[(category, tuple([get_top(c)[-1] for c in children]))]
+
+
+def rule_table(grammar: AbsGrammar, surface_rules: SurfaceRule, matching_rules: MatchingRule) -> RuleTable:
+    return RuleTable(ids=grammar.rule_ids,
+                     linearizations=[surface_rules.get(rule) for rule in grammar.rules],
+                     annotations=[matching_rules.get(rule) for rule in grammar.rules])
+
+
 def get_rule(category: CategoryMeta, children: tuple[LabeledTree, ...]) -> AbsRule:
     children_categories = tuple(map(lambda c: get_top(c)[-1], children))
     return AbsRule(category, children_categories)
 
 
-def get_matchings(tree: LabeledTree, matching_rules: MatchingRule, inheritance: Maybe[int] = None) -> Matching:
+def get_annotation(matching_rules: Union[MatchingRule, RuleTable], category: CategoryMeta,
+                   children: tuple[LabeledTree, ...]) -> Annotation:
+    if isinstance(matching_rules, RuleTable):
+        return matching_rules.annotations[matching_rules.rule_id(category, children)]
+    return matching_rules[get_rule(category, children)]
+
+
+def get_linearization(surface_rules: Union[SurfaceRule, RuleTable], category: CategoryMeta,
+                      children: tuple[LabeledTree, ...]) -> Linearization:
+    if isinstance(surface_rules, RuleTable):
+        return surface_rules.linearizations[surface_rules.rule_id(category, children)]
+    return surface_rules[get_rule(category, children)]
+
+
+def get_matchings(tree: LabeledTree, matching_rules: Union[MatchingRule, RuleTable],
+                  inheritance: Maybe[int] = None) -> Matching:
     if len(tree) == 3:
         return {}
     (_, _, category), children = tree
-    abs_rule = get_rule(category, children)
-    branch_matches, inheritances = matching_rules[abs_rule]
+    branch_matches, inheritances = get_annotation(matching_rules, category, children)
     ret = {children[k][1]: get_top(children[v])[0] if v is not None else inheritance
            for k, v in branch_matches.items()}
     for child, inh in zip(children, inheritances):
@@ -58,10 +101,16 @@ def get_matchings(tree: LabeledTree, matching_rules: MatchingRule, inheritance:
 
 
 def project_tree(tree: LabeledTree) -> list[CategoryMeta]:
-    if len(tree) == 3:
-        return [tree[2]]
-    _, children = tree
-    return sum([project_tree(c) for c in children], [])
+    leaves: list[CategoryMeta] = []
+
+    def _f(_tree: LabeledTree) -> None:
+        if len(_tree) == 3:
+            leaves.append(_tree[2])
+        else:
+            for child in _tree[1]:
+                _f(child)
+    _f(tree)
+    return leaves
 
 
 def has_no_duplicates(realized: Realized, types: list[CategoryMeta], exclude: set[CategoryMeta] = frozenset()) -> bool:
@@ -74,27 +123,134 @@ def realized_to_strs(realized: Realized) -> tuple[str, ...]:
     return tuple(r[2] for r in realized)
 
 
+def choice_constraints(leaves: list[CategoryMeta], realization: SpanRealization, exclude: set[CategoryMeta]) \
+        -> Callable[[list[Category], set[str], Category], Maybe[set[str]]]:
+    # checks the next leaf's constant against the assigned prefix, returning the strings it adds to the used set
+    owners = [idx for _, _, (idx, _) in realization]
+    spans: list[list[tuple[int, int]]] = [[] for _ in leaves]
+    for position, (_, _, (idx, coord)) in enumerate(realization):
+        spans[idx].append((position, coord))
+    neighbours = [[(coord, owners[q], realization[q][2][1]) for p, coord in spans[i] for q in (p - 1, p + 1)
+                   if 0 <= q < len(realization) and owners[q] <= i] for i in range(len(leaves))]
+    distinct = [leaf not in exclude for leaf in leaves]
+
+    def accept(choice: list[Category], used: set[str], constant: Category) -> Maybe[set[str]]:
+        i = len(choice)
+        if any(constant[coord] == (constant if j == i else choice[j])[other] for coord, j, other in neighbours[i]):
+            return None
+        if not distinct[i]:
+            return set()
+        strs = {constant[coord] for _, coord in spans[i]}
+        return strs if len(strs) == len(spans[i]) and used.isdisjoint(strs) else None
+    return accept
+
+
 def get_choices(
         leaves: list[CategoryMeta],
         realization: SpanRealization,
-        exclude: set[CategoryMeta] = frozenset()) -> Iterator[Realized]:
-    def rspan(c) -> Realized: return realize_span(c, realization)
-    def rtypes(c) -> list[CategoryMeta]: return realize_types(c, realization)
-    def ndupes(c) -> bool: return has_no_duplicates(c, rtypes(c), exclude)
-    return map(rspan, filter(ndupes, product(*map(lambda cat: cat.constants, leaves))))
+        exclude: set[CategoryMeta] = frozenset(),
+        lexicon: Maybe[LexicalBinding] = None) -> Iterator[Realized]:
+    return map(lambda choice: realize_span(choice, realization),
+               get_assignments(leaves, realization, exclude, lexicon))
+
+
+def get_assignments(
+        leaves: list[CategoryMeta],
+        realization: SpanRealization,
+        exclude: set[CategoryMeta] = frozenset(),
+        lexicon: Maybe[LexicalBinding] = None) -> Iterator[tuple[Category, ...]]:
+    # backtracking over the leaves in product order, pruning on adjacent and repeated (non-excluded) strings
+    lexicon = LexicalBinding() if lexicon is None else lexicon
+    constants = [lexicon.constants(leaf) for leaf in leaves]
+    accept = choice_constraints(leaves, realization, exclude)
+    choice: list[Category] = []
+    used: set[str] = set()
+
+    def extend(i: int) -> Iterator[tuple[Category, ...]]:
+        if i == len(leaves):
+            yield tuple(choice)
+            return
+        for constant in constants[i]:
+            if (strs := accept(choice, used, constant)) is None:
+                continue
+            choice.append(constant)
+            used.update(strs)
+            yield from extend(i + 1)
+            choice.pop()
+            used.difference_update(strs)
+    return extend(0)
 
 
 def sample_choices(
         leaves: list[CategoryMeta],
         span_realization: SpanRealization,
         n: int,
-        exclude: set[CategoryMeta] = frozenset()) -> Iterator[Realized]:
-    for i in range(n):
-        choice = tuple([choose(cat.constants) for cat in leaves])
-        realized = realize_span(choice, span_realization)
-        types = realize_types(choice, span_realization)
-        if has_no_duplicates(realized, types, exclude):
-            yield realized
+        exclude: set[CategoryMeta] = frozenset(),
+        rng: Random = random,
+        lexicon: Maybe[LexicalBinding] = None) -> Iterator[Realized]:
+    return map(lambda choice: realize_span(choice, span_realization),
+               sample_assignments(leaves, span_realization, n, exclude, rng, lexicon))
+
+
+def sample_assignments(
+        leaves: list[CategoryMeta],
+        span_realization: SpanRealization,
+        n: int,
+        exclude: set[CategoryMeta] = frozenset(),
+        rng: Random = random,
+        lexicon: Maybe[LexicalBinding] = None) -> Iterator[tuple[Category, ...]]:
+    # each draw is a randomized backtracking search that skips the assignments already drawn; leaves are searched
+    # fewest constants first, so that conflicts between (near-)fixed leaves are found before branching on the rest
+    lexicon = LexicalBinding() if lexicon is None else lexicon
+    order = sorted(range(len(leaves)), key=lambda idx: len(lexicon.constants(leaves[idx])))
+    position = {idx: p for p, idx in enumerate(order)}
+    leaves = [leaves[idx] for idx in order]
+    constants = [lexicon.constants(leaf) for leaf in leaves]
+    accept = choice_constraints(leaves, [(nps, vps, (position[idx], coord))
+                                         for nps, vps, (idx, coord) in span_realization], exclude)
+    drawn: set[tuple[int, ...]] = set()
+    choice: list[Category] = []
+    indices: list[int] = []
+    used: set[str] = set()
+
+    def draw(i: int) -> bool:
+        if i == len(leaves):
+            return tuple(indices) not in drawn
+        for k in shuffled(len(constants[i]), rng):
+            constant = constants[i][k]
+            if (strs := accept(choice, used, constant)) is None:
+                continue
+            choice.append(constant)
+            indices.append(k)
+            used.update(strs)
+            if draw(i + 1):
+                return True
+            choice.pop()
+            indices.pop()
+            used.difference_update(strs)
+        return False
+
+    for drawn_so_far in range(n):
+        if not draw(0):
+            warn(f'Only {drawn_so_far} distinct assignments exist; {n} were requested.')
+            return
+        drawn.add(tuple(indices))
+        yield tuple(choice[position[idx]] for idx in range(len(leaves)))
+        choice.clear()
+        indices.clear()
+        used.clear()
+
+
+def shuffled(n: int, rng: Random) -> Iterator[int]:
+    # a lazy random permutation of range(n): cheap when only a few of its elements are consumed
+    seen = set()
+    while len(seen) < n // 2:
+        if (k := rng.randrange(n)) not in seen:
+            seen.add(k)
+            yield k
+    rest = [k for k in range(n) if k not in seen]
+    rng.shuffle(rest)
+    yield from rest
 
 
 def realize_span(leaves: Sequence[Category], span_realization: SpanRealization) -> Realized:
@@ -107,57 +263,314 @@ def realize_types(leaves: Sequence[Category], span_realization: SpanRealization)
 
 
 def labeled_tree_to_realization(
-        tree: LabeledTree, surface_rules: SurfaceRule, np_labels: list[int], vp_labels: list[int],
+        tree: LabeledTree, surface_rules: Union[SurfaceRule, RuleTable], np_labels: list[int], vp_labels: list[int],
         offset: int = 0) -> tuple[int, list[SpanRealization]]:
-
-    def _f(_tree: LabeledTree, _offset: int) -> tuple[int, list[SpanRealization]]:
-        return labeled_tree_to_realization(_tree, surface_rules, np_labels, vp_labels, _offset)
+    # each coordinate is built as a rope over the children's coordinates, and flattened once at the end
 
     def add_to_inheritance(_inheritance: list[int], new_idx: Maybe[int]) -> list[int]:
         return _inheritance if new_idx is None else _inheritance + [new_idx]
 
-    if len(tree) == 3:
-        np_idx, vp_idx, category = tree
-        np_labels, vp_labels = add_to_inheritance(np_labels, np_idx), add_to_inheritance(vp_labels, vp_idx)
-        return offset + 1, [[(np_labels, vp_labels, (offset, i))] for i in range(category.arity)]
-
-    (np_idx, vp_idx, category), children = tree
-    np_labels = add_to_inheritance(np_labels, np_idx)
-    vp_labels = add_to_inheritance(vp_labels, vp_idx)
-    abs_rule = get_rule(category, children)
-    surf_rule: tuple[list[tuple[int, int]], ...] = surface_rules[abs_rule]
-    branch_realizations: list[list[SpanRealization]] = []
-    for child in children:
-        offset, branch_realization = _f(child, offset)
-        branch_realizations.append(branch_realization)
-    return offset, [sum([branch_realizations[idx][crd] for idx, crd in res_crd], []) for res_crd in surf_rule]
+    def _f(_tree: LabeledTree, _np_labels: list[int], _vp_labels: list[int]) -> list[Rope]:
+        nonlocal offset
+        if len(_tree) == 3:
+            np_idx, vp_idx, category = _tree
+            span_labels = add_to_inheritance(_np_labels, np_idx), add_to_inheritance(_vp_labels, vp_idx)
+            offset += 1
+            return [[(*span_labels, (offset - 1, i))] for i in range(category.arity)]
+        (np_idx, vp_idx, category), children = _tree
+        _np_labels, _vp_labels = add_to_inheritance(_np_labels, np_idx), add_to_inheritance(_vp_labels, vp_idx)
+        branch_ropes = [_f(child, _np_labels, _vp_labels) for child in children]
+        surf_rule: Linearization = get_linearization(surface_rules, category, children)
+        return [[branch_ropes[idx][crd] for idx, crd in res_crd] for res_crd in surf_rule]
+
+    return offset, list(map(flatten_rope, _f(tree, np_labels, vp_labels)))
+
+
+def flatten_rope(rope: Rope) -> SpanRealization:
+    spans, stack = [], [iter(rope)]
+    while stack:
+        for piece in stack[-1]:
+            if isinstance(piece, list):
+                stack.append(iter(piece))
+                break
+            spans.append(piece)
+        else:
+            stack.pop()
+    return spans
+
+
+@dataclass(frozen=True)
+class Template:
+    labeled_tree:   LabeledTree
+    matching:       Matching
+    leaves:         list[CategoryMeta]
+    realization:    SpanRealization
+    np_labels:      tuple[list[int], ...]
+    vp_labels:      tuple[list[int], ...]
+    positions:      tuple[int, ...]
+
+    def realize(self, choice: Sequence[Category]) -> Realized:
+        surface = tuple(s for c in choice for s in c.surface)
+        return list(zip(self.np_labels, self.vp_labels, map(surface.__getitem__, self.positions)))
+
+
+def compile_tree(tree: AbsTree, rules: RuleTable, nouns: set[CategoryMeta], verbs: set[CategoryMeta]) -> Template:
+    labeled_tree = abstree_to_labeledtree(tree, nouns, verbs, iter(range(999)), iter(range(999)))
+    return make_template(labeled_tree, get_matchings(labeled_tree, rules),
+                         labeled_tree_to_realization(labeled_tree, rules, [], [])[1][0])
+
+
+def make_template(labeled_tree: LabeledTree, matching: Matching, realization: SpanRealization) -> Template:
+    leaves = project_tree(labeled_tree)
+    offsets = list(accumulate((leaf.arity for leaf in leaves), initial=0))
+    return Template(labeled_tree=labeled_tree,
+                    matching=matching,
+                    leaves=leaves,
+                    realization=realization,
+                    np_labels=tuple(nps for nps, _, _ in realization),
+                    vp_labels=tuple(vps for _, vps, _ in realization),
+                    positions=tuple(offsets[idx] + coord for _, _, (idx, coord) in realization))
+
+
+def within(n: int, length: Length) -> bool:
+    min_length, max_length, _ = length
+    return min_length <= n and (max_length is None or n <= max_length)
+
+
+def token_count(realized: Realized) -> int:
+    return sum(len(surface.split()) for _, _, surface in realized)
+
+
+def realize_template(template: Template, sample: Maybe[int], exclude_candidates: set[CategoryMeta],
+                     vocabulary: Maybe['Vocabulary'] = None, rng: Random = random,
+                     lexicon: Maybe[LexicalBinding] = None, length: Length = UNBOUNDED) -> Iterator[Realized]:
+    # with a window on tokens, a tree's constants may realize it with more or fewer tokens than the window allows,
+    # and those surfaces are dropped (after sampling, so a tree may be left with fewer than `sample`)
+    if vocabulary is not None and sample is None:
+        from .span_batching import get_choices_batched
+        return get_choices_batched(template.leaves, template.realization, exclude_candidates, vocabulary,
+                                   length=length)
+    if sample is None:
+        choices = get_assignments(template.leaves, template.realization, exclude_candidates, lexicon)
+    else:
+        choices = sample_assignments(template.leaves, template.realization, sample, exclude_candidates, rng,
+                                     lexicon)
+    surfaces = map(template.realize, choices)
+    return (realized for realized in surfaces if within(token_count(realized), length)) if length[2] else surfaces
+
+
+def enumerate_trees(grammar: AbsGrammar, terminal: CategoryMeta, depth: int, tree_sample: Maybe[int] = None,
+                    length: Length = UNBOUNDED, rng: Random = random) -> Iterator[AbsTree]:
+    # `length` is the (min_length, max_length, tokens) window of `AbsGrammar.generate`; samples are drawn from `rng`,
+    # and unranked from the counts of the trees in the window, so that it is never enumerated
+    # trees are streamed, within the window or not, so that only subproblems of at most `grammar.stream_chunk` trees
+    # are ever materialized
+    min_length, max_length, tokens = length
+    if tree_sample is not None:
+        return iter(grammar.sample(terminal, depth, tree_sample, rng, min_length=min_length, max_length=max_length,
+                                   tokens=tokens))
+    return grammar.generate(terminal, depth, stream=True, min_length=min_length, max_length=max_length, tokens=tokens)
+
+
+@dataclass(frozen=True)
+class ExhaustOptions:
+    # how `exhaust_trees` and the functions built on it produce and realize their trees
+    tree_sample:    Maybe[int] = None
+    length:         Length = UNBOUNDED
+    cache:          Maybe['TreeCache'] = None
+    batched:        bool = False
+    workers:        Maybe[int] = None
+    chunk_size:     int = 64
+    seed:           Maybe[int] = None
+
+
+def exhaust_trees(
+        grammar: AbsGrammar,
+        terminal: CategoryMeta,
+        surface_rules: SurfaceRule,
+        matching_rules: MatchingRule,
+        max_depth: int,
+        nouns: set[CategoryMeta],
+        verbs: set[CategoryMeta],
+        sample: Maybe[int] = None,
+        min_depth: int = 0,
+        exclude_candidates: set[CategoryMeta] = frozenset(),
+        *,
+        options: ExhaustOptions = ExhaustOptions(),
+        templates: Maybe[dict[AbsTree, Template]] = None,
+        trees: Maybe[dict[int, list[AbsTree]]] = None,
+        lexicon: Maybe[LexicalBinding] = None) \
+        -> Iterator[tuple[int, LabeledTree, Matching, Iterator[Realized]]]:
+    # the trees of `terminal` from `min_depth` up to `max_depth`, one at a time and in depth order, each with its
+    # matching and its surfaces, produced on demand from the constants `lexicon` binds (or the categories' own).
+    # Each depth's trees are enumerated, or sampled with `options.tree_sample`, among those whose yield fits
+    # `options.length`; `options.cache` keeps them and their templates on disk across runs, while `trees` and
+    # `templates` keep them in memory across calls, recording the depths `trees` misses once consumed in full.
+    # Surfaces are realized in chunks of `options.chunk_size` trees, here or by a pool of `options.workers`
+    # processes; with `options.seed`, chunk k of depth d samples from a generator seeded by (seed, d, k) and the
+    # trees of depth d are sampled from one seeded by (seed, d), so that results depend neither on the number of
+    # workers nor on whether there are any
+    grammar = grammar if lexicon is None else grammar.bind(lexicon)
+    compiled = grammar.compile(surface_rules, matching_rules)
+    rules = rule_table(grammar, surface_rules, matching_rules)
+    tree_sample, cache, seed, chunk_size = options.tree_sample, options.cache, options.seed, options.chunk_size
+    vocabulary = None
+    if options.batched:
+        from .span_batching import Vocabulary
+        vocabulary = Vocabulary(lexicon)
+
+    # a depth's trees are only kept once enumerated in full, so that a depth left unfinished is enumerated anew
+    def record(_trees: Iterator[AbsTree], _depth: int) -> Iterator[AbsTree]:
+        recorded = []
+        for _tree in _trees:
+            recorded.append(_tree)
+            yield _tree
+        trees[_depth] = recorded
+
+    def remember(_compiled: Iterator[tuple[AbsTree, Template]], _depth: int) -> Iterator[tuple[AbsTree, Template]]:
+        recorded = []
+        for _tree, _template in _compiled:
+            recorded.append(_tree)
+            if templates is not None:
+                templates[_tree] = _template
+            yield _tree, _template
+        trees[_depth] = recorded
+
+    def source(_depth: int) -> Iterator[AbsTree]:
+        if cache is None or tree_sample is not None:
+            return enumerate_trees(grammar, terminal, _depth, tree_sample, options.length,
+                                   random if seed is None else Random(f'{seed}:trees:{_depth}'))
+        return cache.trees(grammar, terminal, _depth, options.length)
+
+    def trees_fn(_depth: int) -> Iterator[AbsTree]:
+        if trees is None:
+            return source(_depth)
+        if _depth not in trees:
+            return record(source(_depth), _depth)
+        return iter(trees[_depth])
+
+    def compile_all(_trees: Iterator[AbsTree]) -> Iterator[tuple[AbsTree, Template]]:
+        for _tree in _trees:
+            if templates is None or (_template := templates.get(_tree)) is None:
+                _template = compile_tree(_tree, rules, nouns, verbs)
+                if templates is not None:
+                    templates[_tree] = _template
+            yield _tree, _template
+
+    def templates_fn(_depth: int) -> Iterator[tuple[AbsTree, Template]]:
+        if cache is None or tree_sample is not None or trees is not None and _depth in trees:
+            return compile_all(trees_fn(_depth))
+        compiled_trees = cache.templates(grammar, terminal, _depth, surface_rules, matching_rules, nouns, verbs,
+                                         lambda: compile_all(source(_depth)), options.length)
+        return compiled_trees if trees is None else remember(compiled_trees, _depth)
+
+    if options.workers is not None:
+        from .span_parallel import exhaust_parallel
+        depths = range(min_depth, max_depth)
+        yield from ((depth, labeled_tree, matching, iter(surfaces)) for depth, labeled_tree, matching, surfaces
+                    in exhaust_parallel(grammar, compiled, ((depth, trees_fn(depth)) for depth in depths), nouns,
+                                        verbs, sample, exclude_candidates, options.batched, options.workers, chunk_size,
+                                        random.getrandbits(64) if seed is None else seed, lexicon, options.length))
+        return
+
+    rng = random
+    for depth in range(min_depth, max_depth):
+        for idx, (_, template) in enumerate(templates_fn(depth)):
+            if seed is not None and idx % chunk_size == 0:
+                rng = Random(f'{seed}:{depth}:{idx // chunk_size}')
+            surfaces = realize_template(template, sample, exclude_candidates, vocabulary, rng, lexicon, options.length)
+            if seed is not None and sample is not None:
+                # drawn before the next tree's, however much of them is consumed
+                surfaces = iter(list(surfaces))
+            yield depth, template.labeled_tree, template.matching, surfaces
+
+
+def iterate_grammar(
+        grammar: AbsGrammar,
+        terminal: CategoryMeta,
+        surface_rules: SurfaceRule,
+        matching_rules: MatchingRule,
+        max_depth: int,
+        nouns: set[CategoryMeta],
+        verbs: set[CategoryMeta],
+        sample: Maybe[int] = None,
+        min_depth: int = 0,
+        exclude_candidates: set[CategoryMeta] = frozenset(),
+        *,
+        options: ExhaustOptions = ExhaustOptions(),
+        templates: Maybe[dict[AbsTree, Template]] = None,
+        trees: Maybe[dict[int, list[AbsTree]]] = None,
+        lexicon: Maybe[LexicalBinding] = None) \
+        -> Iterator[tuple[int, LabeledTree, Matching, Realized]]:
+    # the records of `exhaust_trees`, one per realized surface
+    records = exhaust_trees(grammar, terminal, surface_rules, matching_rules, max_depth, nouns, verbs, sample,
+                            min_depth, exclude_candidates, options=options, templates=templates, trees=trees,
+                            lexicon=lexicon)
+    return ((depth, labeled_tree, matching, realized)
+            for depth, labeled_tree, matching, surfaces in records for realized in surfaces)
+
+
+def exhaust_configurations(
+        configure: Callable[[T], Maybe[LexicalBinding]],
+        configurations: Iterable[T],
+        grammar: AbsGrammar,
+        terminal: CategoryMeta,
+        surface_rules: SurfaceRule,
+        matching_rules: MatchingRule,
+        max_depth: int,
+        nouns: set[CategoryMeta],
+        verbs: set[CategoryMeta],
+        sample: Maybe[int] = None,
+        min_depth: int = 0,
+        exclude_candidates: set[CategoryMeta] = frozenset(),
+        *,
+        options: ExhaustOptions = ExhaustOptions(),
+        seeds: Maybe[Callable[[T], Maybe[int]]] = None,
+        per_tree: bool = False) \
+        -> Iterator[tuple[T, Iterator[tuple[int, LabeledTree, Matching, Union[Realized, Iterator[Realized]]]]]]:
+    # the records of each configuration: those of `iterate_grammar`, or with `per_tree` those of `exhaust_trees`,
+    # realized with `options`, seeded by `seeds(configuration)` if given.
+    # `configure` returns the configuration's lexicon, or rebinds the categories' constants and returns None; either
+    # way, a configuration's records must be consumed in full before the next one is requested. Trees are enumerated
+    # (or sampled) and compiled once, and realized anew for each configuration; as the enumeration depends on a
+    # lexicon only through the categories it leaves empty (and, with a window on tokens, the token counts of their
+    # constants), trees are shared among the configurations agreeing on these. They are only kept in memory when
+    # there are several configurations to share them; a single one streams its trees as `exhaust_trees` does
+    configurations = list(configurations)
+    shared = len(configurations) > 1
+    templates: Maybe[dict[AbsTree, Template]] = {} if shared else None
+    trees: dict[tuple[frozenset[CategoryMeta], tuple[Extent, ...]], dict[int, list[AbsTree]]] = {}
+    for configuration in configurations:
+        lexicon = configure(configuration)
+        bound = grammar if lexicon is None else grammar.bind(lexicon)
+        empty = frozenset(c for c in grammar.categories if bound.size(c) == 0)
+        extents = tuple(map(bound.token_extent, grammar.categories)) if options.length[2] else ()
+        yield configuration, (exhaust_trees if per_tree else iterate_grammar)(
+            grammar, terminal, surface_rules, matching_rules, max_depth, nouns, verbs, sample, min_depth,
+            exclude_candidates, options=options if seeds is None else replace(options, seed=seeds(configuration)),
+            templates=templates, trees=trees.setdefault((empty, extents), {}) if shared else None, lexicon=lexicon)
 
 
 def exhaust_grammar(
         grammar: AbsGrammar,
         terminal: CategoryMeta,
-        surface_rules: dict[AbsRule, tuple[list[tuple[int, int]], ...]],
-        matching_rules:  dict[AbsRule, tuple[dict[int, Maybe[int]], tuple[Union[bool, int], ...]]],
+        surface_rules: SurfaceRule,
+        matching_rules: MatchingRule,
         max_depth: int,
         nouns: set[CategoryMeta],
         verbs: set[CategoryMeta],
         sample: Maybe[int] = None,
         min_depth: int = 0,
-        exclude_candidates: set[CategoryMeta] = frozenset()) \
-        -> dict[int, dict[LabeledTree, tuple[Matching, list[Realized]]]]:
-    def choice_fn(leaves: list[CategoryMeta], span_realization: SpanRealization) -> Iterator[Realized]:
-        if sample is None:
-            return get_choices(leaves, span_realization, exclude_candidates)
-        return sample_choices(leaves, span_realization, sample, exclude_candidates)
-
-    def exhaust_tree(_tree: AbsTree) -> tuple[LabeledTree, tuple[Matching, list[Realized]]]:
-        labeled_tree = abstree_to_labeledtree(_tree, nouns, verbs, iter(range(999)), iter(range(999)))
-        realization = labeled_tree_to_realization(labeled_tree, surface_rules, [], [])[1]
-        matching = get_matchings(labeled_tree, matching_rules)
-        surfaces = list(choice_fn(project_tree(labeled_tree), realization[0]))
-        return labeled_tree, (matching, surfaces)
-
-    def exhaust_depth(_depth: int) -> dict[LabeledTree: tuple[Matching, list[Realized]]]:
-        return {k: vs for k, vs in map(exhaust_tree, grammar.generate(terminal, _depth))}
-
-    return {depth: exhaust_depth(depth) for depth in range(min_depth, max_depth)}
+        exclude_candidates: set[CategoryMeta] = frozenset(),
+        *,
+        options: ExhaustOptions = ExhaustOptions(),
+        templates: Maybe[dict[AbsTree, Template]] = None,
+        interned: bool = False,
+        lexicon: Maybe[LexicalBinding] = None) \
+        -> dict[int, dict[Union[LabeledTree, Node], tuple[Matching, list[Realized]]]]:
+    ret = {depth: {} for depth in range(min_depth, max_depth)}
+    for depth, labeled_tree, matching, surfaces in exhaust_trees(
+            grammar, terminal, surface_rules, matching_rules, max_depth, nouns, verbs, sample, min_depth,
+            exclude_candidates, options=options, templates=templates, lexicon=lexicon):
+        ret[depth][to_node(labeled_tree) if interned else labeled_tree] = (matching, list(surfaces))
+    return ret
@@ -0,0 +1,186 @@
+"""
+A tokenized corpus is a directory of flat little-endian arrays, plus a vocabulary with one token per line:
+
+    tokens.i32          token ids of all sentences, back to back
+    offsets.i64         sentence i spans tokens[offsets[i]:offsets[i + 1]]
+    depths.i32          tree depth of each sentence
+    np_labels.i32       NP labels of token t are np_labels[np_offsets[t]:np_offsets[t + 1]] (CSR, likewise for VP)
+    np_offsets.i64
+    vp_labels.i32
+    vp_offsets.i64
+    matchings.i32       (verb, noun) pairs, with -1 for an unmatched verb
+    matching_offsets.i64    sentence i owns matchings[matching_offsets[i]:matching_offsets[i + 1]]
+
+Tokens are the whitespace-separated words of each span, and inherit that span's labels. The word id blocks of the
+batched path are written as they are: each lexicon word is split into tokens once, and whole blocks of sentences are
+laid out with array operations, giving the same arrays as writing their decoded records one by one.
+Offsets are int64 so that corpora beyond 2^31 tokens remain addressable.
+"""
+
+from .span_realization import LabeledTree, Matching, Realized
+from .span_batching import ChoiceBlocks
+from typing import IO, Iterable
+import os
+import numpy as np
+from numpy.typing import NDArray
+
+Example = tuple[list[str], list[list[int]], list[list[int]], Matching, int]
+
+ARRAYS = {'tokens': '<i4', 'offsets': '<i8', 'depths': '<i4', 'np_labels': '<i4', 'np_offsets': '<i8',
+          'vp_labels': '<i4', 'vp_offsets': '<i8', 'matchings': '<i4', 'matching_offsets': '<i8'}
+
+
+def array_path(directory: str, name: str) -> str:
+    return os.path.join(directory, f'{name}.i{np.dtype(ARRAYS[name]).itemsize * 8}')
+
+
+def ragged(starts: NDArray[np.int64], counts: NDArray[np.int64]) -> NDArray[np.int64]:
+    # the indices of the runs starts[i]:starts[i] + counts[i], back to back
+    ends = np.cumsum(counts)
+    return np.arange(ends[-1] if len(ends) else 0) + np.repeat(starts - (ends - counts), counts)
+
+
+class TokenWriter:
+    # appends each record to the arrays as it comes, so only the vocabulary is kept in memory
+    def __init__(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.vocabulary: dict[str, int] = {}
+        self.files: dict[str, IO[bytes]] = {name: open(array_path(directory, name), 'wb') for name in ARRAYS}
+        self.sizes = {'tokens': 0, 'np_labels': 0, 'vp_labels': 0, 'matchings': 0}
+        # the tokens of each word id of the current lexicon: word_tokens[word_starts[w]:][:word_lengths[w]]
+        self.words: list[str] = []
+        self.word_starts = np.zeros(0, dtype=np.int64)
+        self.word_lengths = np.zeros(0, dtype=np.int64)
+        self.word_tokens: list[int] = []
+        self.token_table = np.zeros(0, dtype=np.int64)
+        for name in ('offsets', 'np_offsets', 'vp_offsets', 'matching_offsets'):
+            self.append(name, [0])
+
+    def append(self, name: str, values: list) -> None:
+        self.files[name].write(np.asarray(values, dtype=ARRAYS[name]).tobytes())
+
+    def encode(self, word: str) -> int:
+        return self.vocabulary.setdefault(word, len(self.vocabulary))
+
+    def write_record(self, depth: int, _: LabeledTree, matching: Matching, realized: Realized) -> None:
+        tokens, nps, vps = [], [], []
+        for span_nps, span_vps, span in realized:
+            for word in span.split():
+                tokens.append(self.encode(word))
+                nps.append(span_nps)
+                vps.append(span_vps)
+        pairs = [(verb, -1 if noun is None else noun) for verb, noun in matching.items()]
+        self.append('tokens', tokens)
+        self.append('depths', [depth])
+        for name, labels in (('np', nps), ('vp', vps)):
+            flat = [label for token_labels in labels for label in token_labels]
+            self.append(f'{name}_labels', flat)
+            self.append(f'{name}_offsets', np.cumsum([len(ls) for ls in labels]) + self.sizes[f'{name}_labels'])
+            self.sizes[f'{name}_labels'] += len(flat)
+        self.append('matchings', pairs)
+        self.sizes['matchings'] += len(pairs)
+        self.append('matching_offsets', [self.sizes['matchings']])
+        self.sizes['tokens'] += len(tokens)
+        self.append('offsets', [self.sizes['tokens']])
+
+    def write_records(self, depth: int, tree: LabeledTree, matching: Matching, surfaces: Iterable[Realized]) -> None:
+        # all records of a tree; the word id blocks of the batched path are tokenized without decoding them
+        if not isinstance(surfaces, ChoiceBlocks):
+            for realized in surfaces:
+                self.write_record(depth, tree, matching, realized)
+            return
+        for ids in surfaces.blocks:
+            self.write_block(depth, matching, surfaces.np_labels, surfaces.vp_labels, ids,
+                             surfaces.vocabulary.lexicon.words)
+
+    def translate(self, ids: NDArray[np.int64], words: list[str]) -> None:
+        # splits the words of `ids` not seen yet into tokens, in order of first occurrence, so that tokens get the
+        # ids `write_record` would have given them
+        if words is not self.words:
+            self.words, self.word_starts, self.word_lengths = words, np.zeros(0, dtype=np.int64), \
+                np.zeros(0, dtype=np.int64)
+        if (grow := len(words) - len(self.word_starts)) > 0:
+            self.word_starts = np.concatenate([self.word_starts, np.full(grow, -1, dtype=np.int64)])
+            self.word_lengths = np.concatenate([self.word_lengths, np.zeros(grow, dtype=np.int64)])
+        unseen = ids.ravel()[self.word_starts[ids.ravel()] < 0]
+        new, first = np.unique(unseen, return_index=True)
+        for word in new[np.argsort(first)].tolist():
+            self.word_starts[word] = len(self.word_tokens)
+            self.word_tokens.extend(self.encode(token) for token in words[word].split())
+            self.word_lengths[word] = len(self.word_tokens) - self.word_starts[word]
+        if len(new):
+            self.token_table = np.asarray(self.word_tokens, dtype=np.int64)
+
+    def write_block(self, depth: int, matching: Matching, np_labels: list[list[int]], vp_labels: list[list[int]],
+                    ids: NDArray[np.int64], words: list[str]) -> None:
+        # one record per row of `ids`, whose columns are the word ids of the spans
+        self.translate(ids, words)
+        rows, columns = ids.shape
+        counts = self.word_lengths[ids].ravel()
+        tokens = self.token_table[ragged(self.word_starts[ids].ravel(), counts)]
+        spans = np.repeat(np.tile(np.arange(columns), rows), counts)
+        pairs = np.asarray([(verb, -1 if noun is None else noun) for verb, noun in matching.items()],
+                           dtype=np.int64).reshape(-1, 2)
+        self.append('tokens', tokens)
+        self.append('depths', np.full(rows, depth))
+        for name, labels in (('np', np_labels), ('vp', vp_labels)):
+            lengths = np.array([len(ls) for ls in labels], dtype=np.int64)
+            flat = np.array([label for ls in labels for label in ls], dtype=np.int64)
+            flat = flat[ragged((np.cumsum(lengths) - lengths)[spans], lengths[spans])]
+            self.append(f'{name}_labels', flat)
+            self.append(f'{name}_offsets', np.cumsum(lengths[spans]) + self.sizes[f'{name}_labels'])
+            self.sizes[f'{name}_labels'] += len(flat)
+        self.append('matchings', np.tile(pairs, (rows, 1)))
+        self.append('matching_offsets', self.sizes['matchings'] + len(pairs) * np.arange(1, rows + 1))
+        self.sizes['matchings'] += rows * len(pairs)
+        self.append('offsets', self.sizes['tokens'] + np.cumsum(counts.reshape(rows, columns).sum(axis=1)))
+        self.sizes['tokens'] += len(tokens)
+
+    def close(self) -> None:
+        for file in self.files.values():
+            file.close()
+        with open(os.path.join(self.directory, 'vocabulary.txt'), 'w', encoding='utf-8') as f:
+            f.writelines(f'{word}\n' for word in self.vocabulary)
+
+    def __enter__(self) -> 'TokenWriter':
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+
+class TokenizedCorpus:
+    # zero-copy random access: every array is memory-mapped, and an example is only decoded when indexed
+    def __init__(self, directory: str):
+        with open(os.path.join(directory, 'vocabulary.txt'), 'r', encoding='utf-8') as f:
+            self.words = f.read().splitlines()
+        self.arrays: dict[str, NDArray] = {
+            name: np.memmap(array_path(directory, name), dtype=dtype, mode='r')
+            if os.path.getsize(array_path(directory, name)) > 0 else np.zeros(0, dtype=dtype)
+            for name, dtype in ARRAYS.items()}
+        self.arrays['matchings'] = self.arrays['matchings'].reshape(-1, 2)
+
+    def __len__(self) -> int:
+        return len(self.arrays['depths'])
+
+    def token_ids(self, i: int) -> NDArray[np.int32]:
+        offsets = self.arrays['offsets']
+        return self.arrays['tokens'][offsets[i]:offsets[i + 1]]
+
+    def labels(self, i: int, name: str) -> list[list[int]]:
+        start, stop = self.arrays['offsets'][i:i + 2]
+        offsets, labels = self.arrays[f'{name}_offsets'], self.arrays[f'{name}_labels']
+        return [labels[offsets[t]:offsets[t + 1]].tolist() for t in range(start, stop)]
+
+    def matching(self, i: int) -> Matching:
+        offsets = self.arrays['matching_offsets']
+        return {verb: None if noun == -1 else noun
+                for verb, noun in self.arrays['matchings'][offsets[i]:offsets[i + 1]].tolist()}
+
+    def sentence(self, i: int) -> str:
+        return ' '.join(self.words[t] for t in self.token_ids(i).tolist())
+
+    def __getitem__(self, i: int) -> Example:
+        return ([self.words[t] for t in self.token_ids(i).tolist()], self.labels(i, 'np'), self.labels(i, 'vp'),
+                self.matching(i), int(self.arrays['depths'][i]))
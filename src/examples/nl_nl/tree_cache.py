@@ -0,0 +1,240 @@
+"""
+A directory of enumerated trees, one compressed numpy archive per (grammar, goal, depth), named by a fingerprint of
+everything the enumeration depends on: the rules in order, the goal, the depth, the length window, the categories
+left empty by the lexicon and, for a window on tokens, the least and greatest token count of each category's
+constants. Realization templates are kept in archives of their own, whose fingerprint also covers the surface and
+matching rules and the noun and verb candidates. Neither depends on the words themselves, so runs
+with another lexicon or seed share them.
+
+A tree is stored in preorder, one int per node: the id of the rule expanding it, or -1 for a leaf (its category is
+given by the parent's rule, or is the goal):
+
+    tokens          int32, trees back to back
+    tree_offsets    int64, tree i spans tokens[tree_offsets[i]:tree_offsets[i + 1]]
+
+Template archives add, per node of `tokens`, its (np, vp) labels, with -1 for none; per tree, its (verb, noun)
+matching pairs and its realization spans as (leaf, coordinate) pairs, each span with its NP and VP labels in CSR:
+
+    labels          int32 (n, 2)
+    matchings       int32 (m, 2), with matching_offsets
+    spans           int32 (s, 2), with span_offsets
+    nps, vps        int32, span j owns nps[np_offsets[j]:np_offsets[j + 1]] (likewise for VP)
+
+When the directory outgrows `max_bytes`, the least recently used archives are removed first.
+"""
+
+from ...mcfg import CategoryMeta, AbsTree, AbsRule, AbsGrammar
+from .span_realization import (LabeledTree, Template, MatchingRule, SurfaceRule, Length, UNBOUNDED, make_template,
+                               enumerate_trees)
+from typing import Iterator, Iterable, Callable, Any
+from typing import Optional as Maybe
+from hashlib import sha256
+from zipfile import BadZipFile
+from tempfile import NamedTemporaryFile
+from array import array
+from time import time
+import json
+import os
+import numpy as np
+from numpy.typing import NDArray
+
+FORMAT = 1
+PAIRS = ('labels', 'matchings', 'spans')
+STALE = 60 * 60
+Compiled = tuple[AbsTree, Template]
+
+
+def fingerprint(*parts: Any) -> str:
+    return sha256(json.dumps([FORMAT, *parts]).encode('utf-8')).hexdigest()
+
+
+def encode_rules(grammar: AbsGrammar) -> list:
+    return [[str(rule.lhs), rule.lhs.arity, [[str(c), c.arity] for c in rule.rhs]] for rule in grammar.rules]
+
+
+def encode_rendering(grammar: AbsGrammar, surface_rules: SurfaceRule, matching_rules: MatchingRule,
+                     nouns: set[CategoryMeta], verbs: set[CategoryMeta]) -> list:
+    return [[[idx, surface_rules[rule]] for idx, rule in enumerate(grammar.rules) if rule in surface_rules],
+            [[idx, sorted(matching_rules[rule][0].items()), matching_rules[rule][1]]
+             for idx, rule in enumerate(grammar.rules) if rule in matching_rules],
+            sorted(map(str, nouns)), sorted(map(str, verbs))]
+
+
+def top(tree: AbsTree) -> CategoryMeta:
+    return tree if isinstance(tree, CategoryMeta) else tree[0]
+
+
+def buffer(name: str) -> array:
+    # a growing buffer of the archive array `name`, with the dtype it is stored with (pairs are stored flat)
+    return array('q' if name.endswith('offsets') else 'i')
+
+
+def encode_tree(tree: AbsTree, grammar: AbsGrammar, into: array) -> None:
+    if isinstance(tree, CategoryMeta):
+        into.append(-1)
+        return
+    root, children = tree
+    into.append(grammar.rule_id(root, tuple(map(top, children))))
+    for child in children:
+        encode_tree(child, grammar, into)
+
+
+def encode_labels(tree: LabeledTree, into: array) -> None:
+    np_idx, vp_idx, _ = node = tree if len(tree) == 3 else tree[0]
+    into.extend((-1 if np_idx is None else np_idx, -1 if vp_idx is None else vp_idx))
+    if node is not tree:
+        for child in tree[1]:
+            encode_labels(child, into)
+
+
+def decode_tree(tokens: Iterator[int], category: CategoryMeta, rules: list[AbsRule]) -> AbsTree:
+    if (rule := next(tokens)) < 0:
+        return category
+    return category, tuple(decode_tree(tokens, c, rules) for c in rules[rule].rhs)
+
+
+def decode_labeled(tokens: Iterator[int], labels: Iterator[list[int]], category: CategoryMeta,
+                   rules: list[AbsRule]) -> tuple[AbsTree, LabeledTree]:
+    rule, (np_idx, vp_idx) = next(tokens), next(labels)
+    node = (None if np_idx < 0 else np_idx, None if vp_idx < 0 else vp_idx, category)
+    if rule < 0:
+        return category, node
+    children = [decode_labeled(tokens, labels, c, rules) for c in rules[rule].rhs]
+    return (category, tuple(tree for tree, _ in children)), (node, tuple(labeled for _, labeled in children))
+
+
+def spans(values: NDArray, offsets: NDArray[np.int64]) -> Iterator[list]:
+    # values[offsets[i]:offsets[i + 1]], converted to a list one at a time
+    return (values[offsets[i]:offsets[i + 1]].tolist() for i in range(len(offsets) - 1))
+
+
+class TreeCache:
+    def __init__(self, directory: str, max_bytes: int = 1 << 30):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # archives are made as readable as the umask allows, since the directory may be shared among users
+        umask = os.umask(0)
+        os.umask(umask)
+        self.mode = 0o666 & ~umask
+
+    def key(self, grammar: AbsGrammar, goal: CategoryMeta, depth: int, length: Length = UNBOUNDED) -> str:
+        empty = sorted(str(c) for c in grammar.categories if grammar.size(c) == 0)
+        extents = [[str(c), *grammar.token_extent(c)] for c in grammar.categories] if length[2] else []
+        return fingerprint(encode_rules(grammar), str(goal), depth, empty, list(length), extents)
+
+    def path(self, key: str, kind: str) -> str:
+        return os.path.join(self.directory, f'{key}.{kind}.npz')
+
+    def load(self, path: str) -> Maybe[dict[str, NDArray]]:
+        try:
+            with np.load(path) as archive:
+                arrays = {name: archive[name] for name in archive.files}
+        except (OSError, ValueError, BadZipFile):
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return arrays
+
+    def store(self, path: str, arrays: dict[str, array]) -> None:
+        # written aside to a file of its own and moved in place, so that concurrent writers (processes or threads)
+        # sharing the directory never read, or move in, a partial archive
+        flat = {name: np.frombuffer(values, dtype=values.typecode) for name, values in arrays.items()}
+        f = NamedTemporaryFile(dir=self.directory, suffix='.tmp', delete=False)
+        try:
+            with f:
+                np.savez_compressed(f, **{name: values.reshape(-1, 2) if name in PAIRS else values
+                                          for name, values in flat.items()})
+            os.chmod(f.name, self.mode)
+            os.replace(f.name, path)
+        except BaseException:
+            try:
+                os.remove(f.name)
+            except OSError:
+                pass
+            raise
+        self.evict(keep=path)
+
+    def evict(self, keep: str) -> None:
+        # temporary files count towards `max_bytes` too, but are only removed once left untouched for `STALE` seconds
+        # by a writer that failed to clean up after itself
+        entries, expired = [], time() - STALE
+        for name in os.listdir(self.directory):
+            if name.endswith(('.npz', '.tmp')):
+                try:
+                    stat = os.stat(path := os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes and mtime >= expired:
+                break
+            if path == keep or (mtime >= expired if path.endswith('.tmp') else total <= self.max_bytes):
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                continue
+            total -= size
+
+    def trees(self, grammar: AbsGrammar, goal: CategoryMeta, depth: int, length: Length = UNBOUNDED) \
+            -> Iterator[AbsTree]:
+        # the cached trees of `goal` at `depth`, or its enumeration, stored once consumed in full
+        path = self.path(self.key(grammar, goal, depth, length), 'trees')
+        if (arrays := self.load(path)) is not None:
+            for tokens in spans(arrays['tokens'], arrays['tree_offsets']):
+                yield decode_tree(iter(tokens), goal, grammar.rules)
+            return
+        tokens, offsets = buffer('tokens'), buffer('tree_offsets')
+        offsets.append(0)
+        for tree in enumerate_trees(grammar, goal, depth, length=length):
+            encode_tree(tree, grammar, tokens)
+            offsets.append(len(tokens))
+            yield tree
+        self.store(path, {'tokens': tokens, 'tree_offsets': offsets})
+
+    def templates(self, grammar: AbsGrammar, goal: CategoryMeta, depth: int, surface_rules: SurfaceRule,
+                  matching_rules: MatchingRule, nouns: set[CategoryMeta], verbs: set[CategoryMeta],
+                  compile_all: Callable[[], Iterable[Compiled]], length: Length = UNBOUNDED) -> Iterator[Compiled]:
+        # the cached trees of `goal` at `depth` with their templates, or those of `compile_all`, stored once
+        # consumed in full
+        key = fingerprint(self.key(grammar, goal, depth, length),
+                          encode_rendering(grammar, surface_rules, matching_rules, nouns, verbs))
+        path = self.path(key, 'templates')
+        if (arrays := self.load(path)) is not None:
+            offsets = arrays['tree_offsets']
+            tokens, labels = spans(arrays['tokens'], offsets), spans(arrays['labels'], offsets)
+            matchings = spans(arrays['matchings'], arrays['matching_offsets'])
+            nps, vps = spans(arrays['nps'], arrays['np_offsets']), spans(arrays['vps'], arrays['vp_offsets'])
+            for tree_tokens, tree_labels, pairs, tree_spans in zip(
+                    tokens, labels, matchings, spans(arrays['spans'], arrays['span_offsets'])):
+                tree, labeled_tree = decode_labeled(iter(tree_tokens), iter(tree_labels), goal, grammar.rules)
+                matching = {verb: None if noun < 0 else noun for verb, noun in pairs}
+                realization = [(next(nps), next(vps), (idx, coord)) for idx, coord in tree_spans]
+                yield tree, make_template(labeled_tree, matching, realization)
+            return
+        arrays = {name: buffer(name) for name in ('tokens', 'labels', 'matchings', 'spans', 'nps', 'vps',
+                                                  'tree_offsets', 'matching_offsets', 'span_offsets',
+                                                  'np_offsets', 'vp_offsets')}
+        for name in ('tree_offsets', 'matching_offsets', 'span_offsets', 'np_offsets', 'vp_offsets'):
+            arrays[name].append(0)
+        for tree, template in compile_all():
+            encode_tree(tree, grammar, arrays['tokens'])
+            encode_labels(template.labeled_tree, arrays['labels'])
+            for verb, noun in template.matching.items():
+                arrays['matchings'].extend((verb, -1 if noun is None else noun))
+            for span_nps, span_vps, (idx, coord) in template.realization:
+                arrays['spans'].extend((idx, coord))
+                arrays['nps'].extend(span_nps)
+                arrays['vps'].extend(span_vps)
+                arrays['np_offsets'].append(len(arrays['nps']))
+                arrays['vp_offsets'].append(len(arrays['vps']))
+            for name, values in (('tree', 'tokens'), ('matching', 'matchings'), ('span', 'spans')):
+                arrays[f'{name}_offsets'].append(len(arrays[values]) // (2 if values in PAIRS else 1))
+            yield tree, template
+        self.store(path, arrays)
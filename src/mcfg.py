@@ -1,45 +1,63 @@
-from typing import Union, TypeVar, Iterator, Callable
-from dataclasses import dataclass
-from itertools import product, chain
+from typing import Union, TypeVar, Iterator, Iterable, Callable, Sequence
+from typing import Optional as Maybe
+from collections import OrderedDict
+from math import prod
+from random import Random
+from sys import maxsize
+import random
+from dataclasses import dataclass, field
+from itertools import product, chain, accumulate
+from weakref import WeakValueDictionary
+from array import array
+from copy import copy
 
 
 class Category:
+    __slots__ = ('surface', 'hash')
+
     surface:        tuple[str, ...]
+    hash:           int
 
     def __getitem__(self, item: int):
         return self.surface[item]
 
 
 class CategoryMeta(type):
-    arity:          int
-    _constants:     list[Category] = []
+    arity:              int
+    signature:          int
+    _constants:         list[Category] = []
+    lexicon_version:    int = 0
 
     def __new__(mcs, name: str, arity: int = 1) -> type:
         def _init(cls, *surface: str) -> None:
             if len(surface) != arity:
                 raise TypeError(f'Cannot initialize {mcs} of arity {arity} with an {len(surface)}-tuple.')
             cls.surface = surface
+            cls.hash = hash((type(cls), surface))
 
         def _repr(cls) -> str:
             return f'{name}(surface={str(cls.surface)})'
 
         def _hash(cls) -> int:
-            return hash((type(cls), cls.surface))
+            return cls.hash
 
         def _eq(cls, other: object) -> bool:
-            return isinstance(other, Category) and hash(cls) == hash(other)
+            return cls is other or (isinstance(other, Category) and cls.hash == other.hash
+                                    and type(cls) is type(other) and cls.surface == other.surface)
 
         return super().__new__(mcs, name, (Category,), {
-            'arity': arity, '__init__': _init, '__repr__': _repr, '__hash__': _hash, '__eq__': _eq})
+            'arity': arity, 'signature': hash((name, arity)), '__slots__': (),
+            '__init__': _init, '__repr__': _repr, '__hash__': _hash, '__eq__': _eq})
 
     def __init__(cls, _: str, arity: int = 1):
         super(CategoryMeta, cls).__init__(arity)
 
     def __hash__(cls) -> int:
-        return hash((str(cls), cls.arity))
+        return cls.signature
 
     def __eq__(self, other: object) -> bool:
-        return isinstance(other, CategoryMeta) and hash(self) == hash(other)
+        return self is other or (isinstance(other, CategoryMeta) and self.signature == other.signature
+                                 and self.__name__ == other.__name__ and self.arity == other.arity)
 
     @property
     def constants(cls: 'CategoryMeta') -> list[Category]:
@@ -47,7 +65,11 @@ class CategoryMeta(type):
 
     @constants.setter
     def constants(cls, values: list[Union[str, tuple[str, ...]]]) -> None:
-        cls._constants = list(map(cls, values)) if cls.arity == 1 else list(map(lambda val: cls(*val), values))
+        cls._constants = cls.make(values)
+        CategoryMeta.lexicon_version += 1
+
+    def make(cls, values: list[Union[str, tuple[str, ...]]]) -> list[Category]:
+        return list(map(cls, values)) if cls.arity == 1 else list(map(lambda val: cls(*val), values))
 
     def __str__(cls) -> str:
         return cls.__name__
@@ -56,63 +78,836 @@ class CategoryMeta(type):
         return f"'{str(cls)}'"
 
 
-@dataclass(unsafe_hash=True)
 class AbsRule:
+    # interned on the identity of its categories while in use, so that equal rules are usually the same object
+    __slots__ = ('lhs', 'rhs', 'multiplicity', 'hash', '__weakref__')
+    table: WeakValueDictionary = WeakValueDictionary()
+
     lhs:            CategoryMeta
     rhs:            tuple[CategoryMeta, ...]
     multiplicity:   int
+    hash:           int
+
+    def __new__(cls, lhs: CategoryMeta, rhs: tuple[CategoryMeta, ...]) -> 'AbsRule':
+        # a live rule keeps its categories alive, so their ids cannot be reused while its entry exists
+        key = (id(lhs), tuple(map(id, rhs)))
+        if (rule := cls.table.get(key)) is None:
+            rule = super().__new__(cls)
+            rule.lhs = lhs
+            rule.rhs = rhs
+            rule.multiplicity = max(map(lambda cm: cm.arity, rhs))
+            rule.hash = hash((lhs, rhs))
+            cls.table[key] = rule
+        return rule
+
+    def __repr__(self) -> str:
+        return f'AbsRule(lhs={self.lhs!r}, rhs={self.rhs!r}, multiplicity={self.multiplicity!r})'
+
+    def __hash__(self) -> int:
+        return self.hash
 
-    def __init__(self, lhs: CategoryMeta, rhs: tuple[CategoryMeta, ...]):
-        self.lhs = lhs
-        self.rhs = rhs
-        self.multiplicity = max(map(lambda cm: cm.arity, rhs))
+    def __eq__(self, other: object) -> bool:
+        return self is other or (isinstance(other, AbsRule) and self.hash == other.hash
+                                 and self.lhs == other.lhs and self.rhs == other.rhs)
+
+    def __reduce__(self):
+        return AbsRule, (self.lhs, self.rhs)
 
     @classmethod
     def from_list(cls, signatures: list[tuple[CategoryMeta, tuple[CategoryMeta, ...]]]):
         return list(map(lambda s: cls(*s), signatures))
 
 
+class LexicalBinding:
+    # an explicit binding of categories to constants, with their surface strings preconverted to word ids; categories
+    # without a binding fall back on their class-level constants
+    def __init__(self, bindings: Maybe[dict[CategoryMeta, list[Union[str, tuple[str, ...]]]]] = None):
+        self.words: list[str] = []
+        self.index: dict[str, int] = {}
+        self.bound: dict[CategoryMeta, list[Category]] = {}
+        self.tables: dict[CategoryMeta, array] = {}
+        self.fallbacks: dict[CategoryMeta, array] = {}
+        self.lexicon_version = CategoryMeta.lexicon_version
+        for category, values in ({} if bindings is None else bindings).items():
+            self.bound[category] = category.make(values)
+            self.tables[category] = self.encode_all(self.bound[category])
+
+    def constants(self, category: CategoryMeta) -> list[Category]:
+        return self.bound[category] if category in self.bound else category.constants
+
+    def ids(self, category: CategoryMeta) -> array:
+        # the word ids of the category's constants, row by row: len(constants) rows of category.arity ids
+        if category in self.tables:
+            return self.tables[category]
+        if self.lexicon_version != CategoryMeta.lexicon_version:
+            self.fallbacks.clear()
+            self.lexicon_version = CategoryMeta.lexicon_version
+        if category not in self.fallbacks:
+            self.fallbacks[category] = self.encode_all(category.constants)
+        return self.fallbacks[category]
+
+    def encode(self, word: str) -> int:
+        if word not in self.index:
+            self.index[word] = len(self.words)
+            self.words.append(word)
+        return self.index[word]
+
+    def encode_all(self, constants: list[Category]) -> array:
+        return array('q', (self.encode(s) for c in constants for s in c.surface))
+
+    def install(self) -> None:
+        # writes the bindings back to the categories, for code that still reads `category.constants`
+        for category, constants in self.bound.items():
+            category._constants = constants
+        CategoryMeta.lexicon_version += 1
+
+
 T = TypeVar('T')
 Tree = Union[T, tuple[T, tuple['Tree', ...]]]
 AbsTree = Tree[CategoryMeta]
+Weight = Callable[[CategoryMeta], int]
+Extent = tuple[int, int]
+Measure = Callable[[CategoryMeta], Extent]
+Bounds = dict[tuple[CategoryMeta, int], Maybe[Extent]]
+Bounded = dict[tuple[CategoryMeta, int, int, int], tuple[tuple[AbsTree, Extent], ...]]
+Lengths = dict[tuple[CategoryMeta, int, bool], dict[Extent, int]]
+Linearization = tuple[list[tuple[int, int]], ...]
+Annotation = tuple[dict[int, Maybe[int]], tuple[Union[bool, int], ...]]
 
 
-def realizable(tree: AbsTree) -> bool:
+def realizable(tree: AbsTree, size: Callable[[CategoryMeta], int] = lambda c: len(c.constants)) -> bool:
     if isinstance(tree, CategoryMeta):
-        return len(tree.constants) > 0
+        return size(tree) > 0
     if isinstance(tree, tuple):
-        return all(map(realizable, tree[-1]))
+        return all(map(lambda c: realizable(c, size), tree[-1]))
+
+
+class Chart:
+    def __init__(self, max_trees: Maybe[int] = None):
+        self.max_trees = max_trees
+        self.size = 0
+        self.entries: OrderedDict[tuple[CategoryMeta, int, bool], tuple[AbsTree, ...]] = OrderedDict()
+
+    def get(self, key: tuple[CategoryMeta, int, bool]) -> Maybe[tuple[AbsTree, ...]]:
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        return None
+
+    def put(self, key: tuple[CategoryMeta, int, bool], trees: tuple[AbsTree, ...]) -> None:
+        if self.max_trees is not None and len(trees) > self.max_trees:
+            return
+        self.entries[key] = trees
+        self.size += len(trees)
+        while self.max_trees is not None and self.size > self.max_trees:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.size = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+
+NO_INHERIT, INHERIT = -1, -2
+
+
+@dataclass(frozen=True)
+class CompiledGrammar:
+    # the grammar as flat integer arrays: rule r rewrites lhs[r] to rhs[rhs_offsets[r]:rhs_offsets[r + 1]]
+    names:          tuple[str, ...]
+    arities:        array
+    lhs:            array
+    rhs_offsets:    array
+    rhs:            array
+    # output coordinate k of rule r (lin_offsets[r] <= k < lin_offsets[r + 1]) concatenates the child coordinates
+    # (lin_children[j], lin_coords[j]) for coord_offsets[k] <= j < coord_offsets[k + 1]
+    lin_offsets:    array
+    coord_offsets:  array
+    lin_children:   array
+    lin_coords:     array
+    # matching pairs (match_heads[j], match_targets[j]) of rule r, with NO_INHERIT standing in for None, and
+    # one inheritance code per rhs position (a child index, INHERIT or NO_INHERIT)
+    match_offsets:  array
+    match_heads:    array
+    match_targets:  array
+    inheritances:   array
+
+    def __len__(self) -> int:
+        return len(self.lhs)
+
+    def rule_rhs(self, r: int) -> tuple[int, ...]:
+        return tuple(self.rhs[self.rhs_offsets[r]:self.rhs_offsets[r + 1]])
+
+    def linearization(self, r: int) -> Linearization:
+        return tuple([(self.lin_children[j], self.lin_coords[j])
+                      for j in range(self.coord_offsets[k], self.coord_offsets[k + 1])]
+                     for k in range(self.lin_offsets[r], self.lin_offsets[r + 1]))
+
+    def annotation(self, r: int) -> Annotation:
+        matches = {self.match_heads[j]: None if self.match_targets[j] == NO_INHERIT else self.match_targets[j]
+                   for j in range(self.match_offsets[r], self.match_offsets[r + 1])}
+        codes = self.inheritances[self.rhs_offsets[r]:self.rhs_offsets[r + 1]]
+        return matches, tuple(False if c == NO_INHERIT else True if c == INHERIT else c for c in codes)
+
+    def counts(self, depth: int, weights: Sequence[int]) -> list[list[int]]:
+        # exact[d][c]: number of trees of depth exactly d rooted at category c, with leaves weighted by `weights`
+        exact, upto = [list(weights)], [list(weights)]
+        for d in range(1, depth + 1):
+            row = [0] * len(self.names)
+            below = upto[d - 2] if d > 1 else [0] * len(self.names)
+            for r in range(len(self)):
+                rhs = self.rhs[self.rhs_offsets[r]:self.rhs_offsets[r + 1]]
+                row[self.lhs[r]] += prod(upto[d - 1][c] for c in rhs) - prod(below[c] for c in rhs)
+            exact.append(row)
+            upto.append([u + n for u, n in zip(upto[d - 1], row)])
+        return exact
+
+
+class Counts:
+    # exact[d][c] and upto[d][c] of `CompiledGrammar.counts` under one leaf weighting, extended on demand; the
+    # shared backend of counting, ranking, sampling and streaming
+    def __init__(self, compiled: CompiledGrammar, ids: dict[CategoryMeta, int], weight: Weight,
+                 categories: list[CategoryMeta]):
+        self.compiled = compiled
+        self.ids = ids
+        self.weight = weight
+        self.weights = list(map(weight, categories))
+        self.exact: list[list[int]] = []
+        self.upto: list[list[int]] = []
+
+    def extend(self, depth: int) -> None:
+        if depth >= len(self.exact):
+            self.exact = self.compiled.counts(max(depth, 2 * len(self.exact)), self.weights)
+            self.upto = list(accumulate(self.exact, lambda upto, row: [u + n for u, n in zip(upto, row)]))
+
+    def count(self, category: CategoryMeta, depth: int) -> int:
+        if depth < 0:
+            return 0
+        if (c := self.ids.get(category)) is None:
+            return self.weight(category) if depth == 0 else 0
+        self.extend(depth)
+        return self.exact[depth][c]
+
+    def count_upto(self, category: CategoryMeta, depth: int) -> int:
+        if depth < 0:
+            return 0
+        if (c := self.ids.get(category)) is None:
+            return self.weight(category)
+        self.extend(depth)
+        return self.upto[depth][c]
+
+
+def compile_rules(categories: list[CategoryMeta], rules: list[AbsRule],
+                  surface_rules: Maybe[dict[AbsRule, Linearization]] = None,
+                  matching_rules: Maybe[dict[AbsRule, Annotation]] = None) -> CompiledGrammar:
+    ids = {c: i for i, c in enumerate(categories)}
+    arrays = {name: array('q') for name in ('lhs', 'rhs_offsets', 'rhs', 'lin_offsets', 'coord_offsets',
+                                            'lin_children', 'lin_coords', 'match_offsets', 'match_heads',
+                                            'match_targets', 'inheritances')}
+    for name in ('rhs_offsets', 'lin_offsets', 'coord_offsets', 'match_offsets'):
+        arrays[name].append(0)
+    for rule in rules:
+        arrays['lhs'].append(ids[rule.lhs])
+        arrays['rhs'].extend(ids[c] for c in rule.rhs)
+        arrays['rhs_offsets'].append(len(arrays['rhs']))
+        if surface_rules is not None:
+            for coordinate in check_linearization(rule, surface_rules):
+                arrays['lin_children'].extend(idx for idx, _ in coordinate)
+                arrays['lin_coords'].extend(crd for _, crd in coordinate)
+                arrays['coord_offsets'].append(len(arrays['lin_children']))
+        arrays['lin_offsets'].append(len(arrays['coord_offsets']) - 1)
+        if matching_rules is not None:
+            matches, inheritances = check_annotation(rule, matching_rules)
+            arrays['match_heads'].extend(matches.keys())
+            arrays['match_targets'].extend(NO_INHERIT if v is None else v for v in matches.values())
+            arrays['inheritances'].extend(NO_INHERIT if inh is False else INHERIT if inh is True else inh
+                                          for inh in inheritances)
+        else:
+            arrays['inheritances'].extend(NO_INHERIT for _ in rule.rhs)
+        arrays['match_offsets'].append(len(arrays['match_heads']))
+    return CompiledGrammar(names=tuple(map(str, categories)),
+                           arities=array('q', (c.arity for c in categories)),
+                           **arrays)
+
+
+def check_linearization(rule: AbsRule, surface_rules: dict[AbsRule, Linearization]) -> Linearization:
+    if rule not in surface_rules:
+        raise ValueError(f'No surface rule for {rule.lhs} -> {rule.rhs}.')
+    linearization = surface_rules[rule]
+    if len(linearization) != rule.lhs.arity:
+        raise ValueError(f'Surface rule for {rule.lhs} -> {rule.rhs} has {len(linearization)} coordinates, '
+                         f'but {rule.lhs} has arity {rule.lhs.arity}.')
+    used = sorted(piece for coordinate in linearization for piece in coordinate)
+    expected = [(idx, crd) for idx, c in enumerate(rule.rhs) for crd in range(c.arity)]
+    if used != expected:
+        raise ValueError(f'Surface rule for {rule.lhs} -> {rule.rhs} does not use every child coordinate '
+                         f'exactly once: {linearization}.')
+    return linearization
+
+
+def check_annotation(rule: AbsRule, matching_rules: dict[AbsRule, Annotation]) -> Annotation:
+    if rule not in matching_rules:
+        raise ValueError(f'No matching rule for {rule.lhs} -> {rule.rhs}.')
+    matches, inheritances = matching_rules[rule]
+    children = range(len(rule.rhs))
+    if len(inheritances) != len(rule.rhs) or \
+            any(k not in children or (v is not None and v not in children) for k, v in matches.items()) or \
+            any(not isinstance(inh, bool) and inh not in children for inh in inheritances):
+        raise ValueError(f'Matching rule for {rule.lhs} -> {rule.rhs} refers to missing children: '
+                         f'{matching_rules[rule]}.')
+    return matches, inheritances
 
 
 @dataclass
 class AbsGrammar:
-    rules:          list[AbsRule]
-    multiplicity:   int
-
-    def __init__(self, rules: list[AbsRule]):
+    rules:              list[AbsRule]
+    multiplicity:       int
+    # caches and state derived from the rules, left out of equality and repr
+    chart:              Chart = field(compare=False, repr=False)
+    stream_chunk:       int = field(compare=False, repr=False)
+    index:              dict[CategoryMeta, list[AbsRule]] = field(compare=False, repr=False)
+    rule_ids:           dict[tuple[CategoryMeta, tuple[CategoryMeta, ...]], int] = field(compare=False, repr=False)
+    categories:         list[CategoryMeta] = field(compare=False, repr=False)
+    category_ids:       dict[CategoryMeta, int] = field(compare=False, repr=False)
+    compiled:           Maybe[CompiledGrammar] = field(compare=False, repr=False)
+    rule_arrays:        Maybe[CompiledGrammar] = field(compare=False, repr=False)
+    lexicon:            Maybe[LexicalBinding] = field(compare=False, repr=False)
+    productive:         set[CategoryMeta] = field(compare=False, repr=False)
+    productive_index:   dict[CategoryMeta, list[AbsRule]] = field(compare=False, repr=False)
+    lexicon_version:    Maybe[int] = field(compare=False, repr=False)
+
+    def __init__(self, rules: list[AbsRule], max_chart_trees: Maybe[int] = None, stream_chunk: int = 1024):
         self.rules = rules
         self.multiplicity = max(map(lambda rule: rule.multiplicity, rules))
-
-    def generate(self, goal: CategoryMeta, depth: int, filter_empty: bool = True) -> Iterator[AbsTree]:
-        ret = self.expand_tree(goal, depth)
-        ret = filter(realizable, ret) if filter_empty else ret
-        ret = filter(lambda t: get_depth(t) == depth, ret)
-        return ret
-
-    def expand_tree(self, tree: AbsTree, depth: int) -> Iterator[AbsTree]:
+        self.chart = Chart(max_chart_trees)
+        self.stream_chunk = stream_chunk
+        self.index = {}
+        for rule in rules:
+            self.index.setdefault(rule.lhs, []).append(rule)
+        self.rule_ids = {(rule.lhs, rule.rhs): idx for idx, rule in enumerate(rules)}
+        self.categories = list(dict.fromkeys(c for rule in rules for c in (rule.lhs, *rule.rhs)))
+        self.category_ids = {c: idx for idx, c in enumerate(self.categories)}
+        self.compiled = None
+        self.rule_arrays = None
+        self.lexicon = None
+        self.productive = set()
+        self.productive_index = {}
+        self.lexicon_version = None
+
+    def refresh(self) -> None:
+        if self.lexicon_version == CategoryMeta.lexicon_version:
+            return
+        self.productive = {c for rule in self.rules for c in (rule.lhs, *rule.rhs) if self.size(c) > 0}
+        changed = True
+        while changed:
+            new = {rule.lhs for rule in self.rules if all(c in self.productive for c in rule.rhs)}
+            changed = not new <= self.productive
+            self.productive |= new
+        self.productive_index = {lhs: [rule for rule in rules if all(c in self.productive for c in rule.rhs)]
+                                 for lhs, rules in self.index.items()}
+        self.chart.clear()
+        self.lexicon_version = CategoryMeta.lexicon_version
+
+    def bind(self, lexicon: LexicalBinding) -> 'AbsGrammar':
+        # a view of this grammar that reads its constants from `lexicon`, with a chart of its own
+        bound = copy(self)
+        bound.chart = Chart(self.chart.max_trees)
+        bound.productive, bound.productive_index, bound.lexicon_version = set(), {}, None
+        bound.lexicon = lexicon
+        return bound
+
+    def size(self, category: CategoryMeta) -> int:
+        return len(category.constants if self.lexicon is None else self.lexicon.constants(category))
+
+    def rule_id(self, lhs: CategoryMeta, rhs: tuple[CategoryMeta, ...]) -> int:
+        return self.rule_ids[(lhs, rhs)]
+
+    def compile(self, surface_rules: Maybe[dict[AbsRule, Linearization]] = None,
+                matching_rules: Maybe[dict[AbsRule, Annotation]] = None) -> CompiledGrammar:
+        self.compiled = compile_rules(self.categories, self.rules, surface_rules, matching_rules)
+        return self.compiled
+
+    def counting(self) -> CompiledGrammar:
+        # rule arrays to count over: the full compile when there is one, otherwise a rules-only compile kept apart
+        # from `compiled`, so that counting never stands in for the surface and matching tables
+        if self.compiled is not None:
+            return self.compiled
+        if self.rule_arrays is None:
+            self.rule_arrays = compile_rules(self.categories, self.rules)
+        return self.rule_arrays
+
+    def count_table(self, weight: Weight) -> Counts:
+        return Counts(self.counting(), self.category_ids, weight, self.categories)
+
+    def generate(self, goal: CategoryMeta, depth: int, filter_empty: bool = True, stream: bool = False,
+                 min_length: int = 0, max_length: Maybe[int] = None, tokens: bool = False) -> Iterator[AbsTree]:
+        # with a length window, only trees whose yield has between `min_length` and `max_length` leaves are generated,
+        # in the same order; with `tokens`, those whose yield can be realized with between `min_length` and
+        # `max_length` whitespace-separated tokens, as their surfaces are not all of the same length
+        if min_length > 0 or max_length is not None:
+            hi, weight = maxsize if max_length is None else max_length, self.length_measure(tokens)
+            if stream:
+                return (tree for tree, _ in self.stream_bounded(
+                    goal, depth, filter_empty, min_length, hi, weight, {}, {},
+                    self.count_table(leaf_weight(filter_empty, self.size))))
+            return (tree for tree, _ in self.bounded_exact(goal, depth, filter_empty, min_length, hi, weight, {}, {}))
+        if stream:
+            return self.stream_exact(goal, depth, filter_empty, self.count_table(leaf_weight(filter_empty, self.size)))
+        return self.expand_exact(goal, depth, filter_empty)
+
+    def length_bounds(self, goal: CategoryMeta, depth: int, filter_empty: bool = True, tokens: bool = False) \
+            -> Maybe[tuple[int, int]]:
+        return self.yield_bounds(goal, depth, filter_empty, self.length_measure(tokens), {})
+
+    def length_measure(self, tokens: bool) -> Measure:
+        # the least and greatest length of a leaf: one, or with `tokens` the number of whitespace-separated tokens
+        # of its constants
+        return self.token_extent if tokens else lambda _: (1, 1)
+
+    def token_extent(self, category: CategoryMeta) -> Extent:
+        constants = category.constants if self.lexicon is None else self.lexicon.constants(category)
+        lengths = [sum(len(s.split()) for s in constant.surface) for constant in constants]
+        return (min(lengths), max(lengths)) if lengths else (0, 0)
+
+    def yield_bounds(self, category: CategoryMeta, depth: int, filter_empty: bool, weight: Measure,
+                     memo: Bounds) -> Maybe[Extent]:
+        # the least and greatest yield length of the trees of `category` at exactly `depth`, or None if it has none
+        if depth < 0:
+            return None
+        if (category, depth) not in memo:
+            if depth == 0:
+                memo[(category, depth)] = weight(category) if not filter_empty or self.size(category) > 0 else None
+            else:
+                bounds = [b for rule in self.applicable(category, filter_empty) for i in range(len(rule.rhs))
+                          if (b := self.block_bounds(rule.rhs, block_depths(len(rule.rhs), i, depth), filter_empty,
+                                                     weight, memo)) is not None]
+                memo[(category, depth)] = (min(lo for lo, _ in bounds), max(hi for _, hi in bounds)) \
+                    if bounds else None
+        return memo[(category, depth)]
+
+    def block_bounds(self, rhs: tuple[CategoryMeta, ...], depths: list[tuple[int, int]], filter_empty: bool,
+                     weight: Measure, memo: Bounds) -> Maybe[Extent]:
+        # the least and greatest total yield length of children whose depths lie in the given (inclusive) ranges
+        total_lo, total_hi = 0, 0
+        for c, (lo_depth, hi_depth) in zip(rhs, depths):
+            bounds = [b for d in range(lo_depth, hi_depth + 1)
+                      if (b := self.yield_bounds(c, d, filter_empty, weight, memo)) is not None]
+            if not bounds:
+                return None
+            total_lo += min(lo for lo, _ in bounds)
+            total_hi += max(hi for _, hi in bounds)
+        return total_lo, total_hi
+
+    def bounded_exact(self, category: CategoryMeta, depth: int, filter_empty: bool, lo: int, hi: int,
+                      weight: Measure, memo: Bounds, bounded: Bounded) -> Iterator[tuple[AbsTree, Extent]]:
+        # same order as `exact`, restricted to trees whose least yield length is at most `hi` and whose greatest is
+        # at least `lo`, each with these two lengths; subtrees are only expanded if the yield bounds of their
+        # siblings leave room for them
+        if (bounds := self.yield_bounds(category, depth, filter_empty, weight, memo)) is None \
+                or bounds[1] < lo or bounds[0] > hi:
+            return
+        if depth == 0:
+            yield category, bounds
+            return
+        for rule in self.applicable(category, filter_empty):
+            for i in range(len(rule.rhs)):
+                yield from (((category, children), n) for children, n in self.bounded_block(
+                    rule.rhs, block_depths(len(rule.rhs), i, depth), filter_empty, lo, hi, weight, memo, bounded))
+
+    def bounded_block(self, rhs: tuple[CategoryMeta, ...], depths: list[tuple[int, int]], filter_empty: bool,
+                      lo: int, hi: int, weight: Measure, memo: Bounds, bounded: Bounded) \
+            -> Iterator[tuple[tuple[AbsTree, ...], Extent]]:
+        if not rhs:
+            if lo <= 0 <= hi:
+                yield (), (0, 0)
+            return
+        if (rest := self.block_bounds(rhs[1:], depths[1:], filter_empty, weight, memo)) is None:
+            return
+        for d in range(depths[0][0], depths[0][1] + 1):
+            for tree, n in self.bounded_trees(rhs[0], d, filter_empty, lo - rest[1], hi - rest[0], weight, memo,
+                                              bounded):
+                yield from (((tree, *children), plus(n, m)) for children, m in self.bounded_block(
+                    rhs[1:], depths[1:], filter_empty, lo - n[1], hi - n[0], weight, memo, bounded))
+
+    def bounded_trees(self, category: CategoryMeta, depth: int, filter_empty: bool, lo: int, hi: int,
+                      weight: Measure, memo: Bounds, bounded: Bounded) -> tuple[tuple[AbsTree, Extent], ...]:
+        # the subtrees of `bounded_exact`, materialized once per window (clipped to the category's own bounds)
+        if (bounds := self.yield_bounds(category, depth, filter_empty, weight, memo)) is None:
+            return ()
+        key = (category, depth, max(lo, bounds[0]), min(hi, bounds[1]))
+        if key not in bounded:
+            bounded[key] = tuple(self.bounded_exact(category, depth, filter_empty, lo, hi, weight, memo, bounded))
+        return bounded[key]
+
+    def stream_bounded(self, category: CategoryMeta, depth: int, filter_empty: bool, lo: int, hi: int,
+                       weight: Measure, memo: Bounds, bounded: Bounded, counts: Counts) \
+            -> Iterator[tuple[AbsTree, Extent]]:
+        # same order as `bounded_exact`, pruned alike; only subproblems of at most `stream_chunk` trees are
+        # materialized (once per window, in `bounded`)
+        if (bounds := self.yield_bounds(category, depth, filter_empty, weight, memo)) is None \
+                or bounds[1] < lo or bounds[0] > hi:
+            return
+        if depth == 0:
+            yield category, bounds
+            return
+        if counts.count(category, depth) <= self.stream_chunk:
+            yield from self.bounded_trees(category, depth, filter_empty, lo, hi, weight, memo, bounded)
+            return
+        for rule in self.applicable(category, filter_empty):
+            for i in range(len(rule.rhs)):
+                yield from (((category, children), n) for children, n in self.stream_bounded_block(
+                    rule.rhs, block_depths(len(rule.rhs), i, depth), filter_empty, lo, hi, weight, memo, bounded,
+                    counts))
+
+    def stream_bounded_block(self, rhs: tuple[CategoryMeta, ...], depths: list[tuple[int, int]],
+                             filter_empty: bool, lo: int, hi: int, weight: Measure, memo: Bounds, bounded: Bounded,
+                             counts: Counts) -> Iterator[tuple[tuple[AbsTree, ...], Extent]]:
+        # the rest of the block is streamed anew for every first child, like the callable options of `lazy_product`
+        if not rhs:
+            if lo <= 0 <= hi:
+                yield (), (0, 0)
+            return
+        if (rest := self.block_bounds(rhs[1:], depths[1:], filter_empty, weight, memo)) is None:
+            return
+        for d in range(depths[0][0], depths[0][1] + 1):
+            for tree, n in self.stream_bounded(rhs[0], d, filter_empty, lo - rest[1], hi - rest[0], weight, memo,
+                                               bounded, counts):
+                yield from (((tree, *children), plus(n, m)) for children, m in self.stream_bounded_block(
+                    rhs[1:], depths[1:], filter_empty, lo - n[1], hi - n[0], weight, memo, bounded, counts))
+
+    def yield_counts(self, category: CategoryMeta, depth: int, filter_empty: bool, weight: Measure,
+                     memo: Lengths) -> dict[Extent, int]:
+        # the number of trees of `category` at exactly `depth`, by least and greatest yield length
+        if depth < 0:
+            return {}
+        if (category, depth, False) not in memo:
+            if depth == 0:
+                memo[(category, depth, False)] = {weight(category): 1} \
+                    if not filter_empty or self.size(category) > 0 else {}
+            else:
+                memo[(category, depth, False)] = add_counts(
+                    self.block_counts(rule.rhs, block_depths(len(rule.rhs), i, depth), filter_empty, weight, memo)
+                    for rule in self.applicable(category, filter_empty) for i in range(len(rule.rhs)))
+        return memo[(category, depth, False)]
+
+    def upto_counts(self, category: CategoryMeta, depth: int, filter_empty: bool, weight: Measure,
+                    memo: Lengths) -> dict[Extent, int]:
+        # the number of trees of `category` at most `depth` deep, by yield length
+        if depth < 0:
+            return {}
+        if (category, depth, True) not in memo:
+            memo[(category, depth, True)] = add_counts((
+                self.upto_counts(category, depth - 1, filter_empty, weight, memo),
+                self.yield_counts(category, depth, filter_empty, weight, memo)))
+        return memo[(category, depth, True)]
+
+    def block_counts(self, rhs: tuple[CategoryMeta, ...], depths: list[tuple[int, int]], filter_empty: bool,
+                     weight: Measure, memo: Lengths) -> dict[Extent, int]:
+        # the number of children whose depths lie in the given ranges of `block_depths`, by total yield length
+        counts = {(0, 0): 1}
+        for c, depth_range in zip(rhs, depths):
+            counts = convolve(counts, self.range_counts(c, depth_range, filter_empty, weight, memo))
+        return counts
+
+    def range_counts(self, category: CategoryMeta, depth_range: tuple[int, int], filter_empty: bool,
+                     weight: Measure, memo: Lengths) -> dict[Extent, int]:
+        # ranges of `block_depths` are either a single depth, or start at 0
+        lo_depth, hi_depth = depth_range
+        return self.yield_counts(category, hi_depth, filter_empty, weight, memo) if lo_depth == hi_depth else \
+            self.upto_counts(category, hi_depth, filter_empty, weight, memo)
+
+    def unrank_weighted(self, category: CategoryMeta, depth: int, k: int, units: dict[Extent, int],
+                        filter_empty: bool, weight: Measure, memo: Lengths) -> tuple[AbsTree, int, Extent]:
+        # in the order of `bounded_exact`, with each tree of yield lengths n spanning `units[n]` consecutive ranks:
+        # the tree spanning rank `k`, the offset of `k` within its span, and its yield lengths
+        if depth == 0:
+            for n in self.yield_counts(category, 0, filter_empty, weight, memo):
+                if k < units.get(n, 0):
+                    return category, k, n
+        else:
+            for rule in self.applicable(category, filter_empty):
+                for i in range(len(rule.rhs)):
+                    depths = block_depths(len(rule.rhs), i, depth)
+                    if k >= (n := weigh(self.block_counts(rule.rhs, depths, filter_empty, weight, memo), units)):
+                        k -= n
+                        continue
+                    children, k, n = self.unrank_block(rule.rhs, depths, k, units, filter_empty, weight, memo)
+                    return (category, children), k, n
+        raise IndexError(f'No weighted tree #{k} of depth {depth} for {category}.')
+
+    def unrank_block(self, rhs: tuple[CategoryMeta, ...], depths: list[tuple[int, int]], k: int,
+                     units: dict[Extent, int], filter_empty: bool, weight: Measure, memo: Lengths) \
+            -> tuple[tuple[AbsTree, ...], int, Extent]:
+        if not rhs:
+            return (), k, (0, 0)
+        # a first child of yield lengths n spans as many ranks as the rest of the block does after it
+        rest = self.block_counts(rhs[1:], depths[1:], filter_empty, weight, memo)
+        first = {n: weigh(rest, shift(units, n))
+                 for n in self.range_counts(rhs[0], depths[0], filter_empty, weight, memo)}
+        for d in range(depths[0][0], depths[0][1] + 1):
+            if k >= (m := weigh(self.yield_counts(rhs[0], d, filter_empty, weight, memo), first)):
+                k -= m
+                continue
+            tree, k, n = self.unrank_weighted(rhs[0], d, k, first, filter_empty, weight, memo)
+            children, k, m = self.unrank_block(rhs[1:], depths[1:], k, shift(units, n), filter_empty, weight, memo)
+            return (tree, *children), k, plus(n, m)
+        raise IndexError(f'No weighted children #{k} for {rhs}.')
+
+    def expand_tree(self, tree: AbsTree, depth: int, filter_empty: bool = False) -> Iterator[AbsTree]:
         if depth < 0:
             return
         if isinstance(tree, CategoryMeta):
-            yield tree
-            for rule in self.applicable(tree):
-                yield from self.expand_tree((tree, rule.rhs), depth - 1)
+            yield from self.expand_upto(tree, depth, filter_empty)
         else:
             root, children = tree
-            options = product(*[list(self.expand_tree(c, depth)) for c in children])
+            options = product(*[list(self.expand_tree(c, depth, filter_empty)) for c in children])
             yield from ((root, p) for p in options)
 
-    def applicable(self, goal: CategoryMeta) -> list[AbsRule]:
-        return [rule for rule in self.rules if rule.lhs == goal]
+    def expand_upto(self, category: CategoryMeta, depth: int, filter_empty: bool = False) -> Iterator[AbsTree]:
+        return chain.from_iterable(self.exact(category, d, filter_empty) for d in range(depth + 1))
+
+    def expand_exact(self, category: CategoryMeta, depth: int, filter_empty: bool = False) -> Iterator[AbsTree]:
+        return iter(self.exact(category, depth, filter_empty))
+
+    def exact(self, category: CategoryMeta, depth: int, filter_empty: bool = False) -> tuple[AbsTree, ...]:
+        self.refresh()
+        if depth < 0:
+            return ()
+        if depth == 0:
+            return (category,) if not filter_empty or self.size(category) > 0 else ()
+        if filter_empty and category not in self.productive:
+            return ()
+        if (trees := self.chart.get((category, depth, filter_empty))) is None:
+            trees = tuple((category, p) for rule in self.applicable(category, filter_empty)
+                          for p in exact_products([self.layers(c, depth - 1, filter_empty) for c in rule.rhs],
+                                                  depth - 1))
+            self.chart.put((category, depth, filter_empty), trees)
+        return trees
+
+    def layers(self, category: CategoryMeta, depth: int, filter_empty: bool = False) -> list[tuple[AbsTree, ...]]:
+        return [self.exact(category, d, filter_empty) for d in range(depth + 1)]
+
+    def stream_exact(self, category: CategoryMeta, depth: int, filter_empty: bool, memo: Counts) \
+            -> Iterator[AbsTree]:
+        # same order as `exact`; only subproblems of at most `stream_chunk` trees are materialized (in the chart)
+        if (n := memo.count(category, depth)) == 0:
+            return
+        if depth == 0:
+            yield category
+            return
+        if n <= self.stream_chunk:
+            yield from self.exact(category, depth, filter_empty)
+            return
+        for rule in self.applicable(category, filter_empty):
+            for i in range(len(rule.rhs)):
+                sizes = self.block_sizes(rule.rhs, i, depth, memo)
+                if prod(sizes) == 0:
+                    continue
+                yield from ((category, p) for p in lazy_product([
+                    self.stream_option(c, depth - 1 if j >= i else depth - 2, j == i, filter_empty, memo, size)
+                    for j, (c, size) in enumerate(zip(rule.rhs, sizes))]))
+
+    def stream_option(self, category: CategoryMeta, depth: int, exact: bool, filter_empty: bool, memo: Counts,
+                      size: int) -> Union[tuple[AbsTree, ...], Callable[[], Iterator[AbsTree]]]:
+        lo = depth if exact else 0
+        if size <= self.stream_chunk:
+            return tuple(chain.from_iterable(self.exact(category, d, filter_empty) for d in range(lo, depth + 1)))
+        return lambda: chain.from_iterable(self.stream_exact(category, d, filter_empty, memo)
+                                           for d in range(lo, depth + 1))
+
+    def count(self, goal: CategoryMeta, depth: int, filter_empty: bool = True) -> int:
+        return self.compiled_count(goal, depth, leaf_weight(filter_empty, self.size))
+
+    def estimate(self, goal: CategoryMeta, depth: int) -> int:
+        return self.compiled_count(goal, depth, self.size)
+
+    def compiled_count(self, goal: CategoryMeta, depth: int, weight: Weight) -> int:
+        return self.count_table(weight).count(goal, depth)
+
+    def rule_count(self, rule: AbsRule, depth: int, memo: Counts) -> int:
+        return (prod(memo.count_upto(c, depth - 1) for c in rule.rhs) -
+                prod(memo.count_upto(c, depth - 2) for c in rule.rhs))
+
+    def block_sizes(self, rhs: tuple[CategoryMeta, ...], i: int, depth: int, memo: Counts) -> list[int]:
+        # sizes of the child ranges of a `depth`-deep tree whose first (depth-1)-deep child is the i-th one
+        return [memo.count_upto(c, depth - 2) for c in rhs[:i]] + \
+               [memo.count(rhs[i], depth - 1)] + \
+               [memo.count_upto(c, depth - 1) for c in rhs[i + 1:]]
+
+    def unrank(self, goal: CategoryMeta, depth: int, k: int, filter_empty: bool = True) -> AbsTree:
+        return self.unrank_exact(goal, depth, k, self.count_table(leaf_weight(filter_empty, self.size)))
+
+    def unrank_exact(self, category: CategoryMeta, depth: int, k: int, memo: Counts) -> AbsTree:
+        if not 0 <= k < memo.count(category, depth):
+            raise IndexError(f'No tree #{k} of depth {depth} for {category}.')
+        if depth == 0:
+            return category
+        for rule in self.applicable(category):
+            if k >= (rule_count := self.rule_count(rule, depth, memo)):
+                k -= rule_count
+                continue
+            for i in range(len(rule.rhs)):
+                sizes = self.block_sizes(rule.rhs, i, depth, memo)
+                if k >= (block := prod(sizes)):
+                    k -= block
+                    continue
+                digits = []
+                for size in reversed(sizes):
+                    k, digit = divmod(k, size)
+                    digits.append(digit)
+                return category, tuple(
+                    self.unrank_exact(c, depth - 1, digit, memo) if j == i else
+                    self.unrank_upto(c, depth - 1 if j > i else depth - 2, digit, memo)
+                    for j, (c, digit) in enumerate(zip(rule.rhs, reversed(digits))))
+
+    def unrank_upto(self, category: CategoryMeta, depth: int, k: int, memo: Counts) -> AbsTree:
+        for d in range(depth + 1):
+            if k < (n := memo.count(category, d)):
+                return self.unrank_exact(category, d, k, memo)
+            k -= n
+        raise IndexError(f'No tree #{k} of depth at most {depth} for {category}.')
+
+    def generate_range(self, goal: CategoryMeta, depth: int, start: int, stop: int, filter_empty: bool = True) \
+            -> Iterator[AbsTree]:
+        memo = self.count_table(leaf_weight(filter_empty, self.size))
+        stop = min(stop, memo.count(goal, depth))
+        return (self.unrank_exact(goal, depth, k, memo) for k in range(start, stop))
+
+    def sample(self, goal: CategoryMeta, depth: int, k: int, rng: Random = random, replace: bool = False,
+               filter_empty: bool = True, min_length: int = 0, max_length: Maybe[int] = None,
+               tokens: bool = False) -> list[AbsTree]:
+        # with a length window, trees are drawn among those `generate` yields for it, and unranked from their counts
+        # by yield lengths
+        if min_length > 0 or max_length is not None:
+            weight, lengths = self.length_measure(tokens), {}
+            hi = maxsize if max_length is None else max_length
+            counts = self.yield_counts(goal, depth, filter_empty, weight, lengths)
+            units = {n: 1 for n in counts if n[0] <= hi and n[1] >= min_length}
+            return [self.unrank_weighted(goal, depth, i, units, filter_empty, weight, lengths)[0]
+                    for i in draw(weigh(counts, units), k, rng, replace)]
+        memo = self.count_table(leaf_weight(filter_empty, self.size))
+        return [self.unrank_exact(goal, depth, i, memo) for i in draw(memo.count(goal, depth), k, rng, replace)]
+
+    def rank(self, tree: AbsTree, filter_empty: bool = True) -> int:
+        if filter_empty and not realizable(tree, self.size):
+            raise ValueError(f'{tree} is not realizable.')
+        return self.rank_exact(tree, self.count_table(leaf_weight(filter_empty, self.size)))[1]
+
+    def rank_exact(self, tree: AbsTree, memo: Counts) -> tuple[int, int]:
+        if isinstance(tree, CategoryMeta):
+            return 0, 0
+        category, children = tree
+        rhs = tuple(c if isinstance(c, CategoryMeta) else c[0] for c in children)
+        ranked = [self.rank_exact(c, memo) for c in children]
+        depth = 1 + max(d for d, _ in ranked)
+        k = 0
+        for rule in self.applicable(category):
+            if rule.rhs == rhs:
+                break
+            k += self.rule_count(rule, depth, memo)
+        else:
+            raise ValueError(f'No rule {category} -> {rhs} in grammar.')
+        i = next(j for j, (d, _) in enumerate(ranked) if d == depth - 1)
+        k += sum(prod(self.block_sizes(rhs, j, depth, memo)) for j in range(i))
+        digits = 0
+        for j, (c, (d, r), size) in enumerate(zip(rhs, ranked, self.block_sizes(rhs, i, depth, memo))):
+            digits = digits * size + (r if j == i else memo.count_upto(c, d - 1) + r)
+        return depth, k + digits
+
+    def applicable(self, goal: CategoryMeta, filter_empty: bool = False) -> list[AbsRule]:
+        if filter_empty:
+            self.refresh()
+            return self.productive_index.get(goal, [])
+        return self.index.get(goal, [])
+
+
+def leaf_weight(filter_empty: bool, size: Callable[[CategoryMeta], int] = lambda c: len(c.constants)) -> Weight:
+    return (lambda c: 1 if size(c) > 0 else 0) if filter_empty else (lambda _: 1)
+
+
+def plus(n: Extent, m: Extent) -> Extent:
+    return n[0] + m[0], n[1] + m[1]
+
+
+def block_depths(arity: int, i: int, depth: int) -> list[tuple[int, int]]:
+    # depth ranges of the children of a `depth`-deep tree whose first (depth-1)-deep child is the i-th one
+    return [(0, depth - 2)] * i + [(depth - 1, depth - 1)] + [(0, depth - 1)] * (arity - i - 1)
+
+
+def convolve(xs: dict[Extent, int], ys: dict[Extent, int]) -> dict[Extent, int]:
+    ret = {}
+    for n, x in xs.items():
+        for m, y in ys.items():
+            ret[plus(n, m)] = ret.get(plus(n, m), 0) + x * y
+    return ret
+
+
+def add_counts(counts: Iterable[dict[Extent, int]]) -> dict[Extent, int]:
+    ret = {}
+    for xs in counts:
+        for n, x in xs.items():
+            ret[n] = ret.get(n, 0) + x
+    return ret
+
+
+def shift(units: dict[Extent, int], n: Extent) -> dict[Extent, int]:
+    return {(m[0] - n[0], m[1] - n[1]): u for m, u in units.items() if m[0] >= n[0] and m[1] >= n[1]}
+
+
+def weigh(counts: dict[Extent, int], units: dict[Extent, int]) -> int:
+    return sum(c * units.get(n, 0) for n, c in counts.items())
+
+
+def draw(n: int, k: int, rng: Random, replace: bool) -> list[int]:
+    # `k` sorted indices below `n`, distinct unless `replace`
+    if n == 0:
+        return []
+    if replace:
+        return sorted(rng.randrange(n) for _ in range(k))
+    if n <= maxsize:
+        return sorted(rng.sample(range(n), min(k, n)))
+    drawn = set()
+    while len(drawn) < k:
+        drawn.add(rng.randrange(n))
+    return sorted(drawn)
+
+
+def exact_products(layers: list[list[Sequence[T]]], depth: int) -> Iterator[tuple[T, ...]]:
+    # the i-th child is the first one of exact depth `depth`: all before it are strictly shallower
+    for i in range(len(layers)):
+        options = [list(chain.from_iterable(ls[:depth])) for ls in layers[:i]] + \
+                  [layers[i][depth]] + \
+                  [list(chain.from_iterable(ls[:depth + 1])) for ls in layers[i + 1:]]
+        yield from product(*options)
+
+
+def lazy_product(options: list[Union[Sequence[T], Callable[[], Iterator[T]]]]) -> Iterator[tuple[T, ...]]:
+    # like itertools.product, but callable options are re-invoked for every prefix instead of being buffered
+    def fresh(option: Union[Sequence[T], Callable[[], Iterator[T]]]) -> Iterator[T]:
+        return option() if callable(option) else iter(option)
+
+    if not options:
+        yield ()
+        return
+    last = len(options) - 1
+    iterators, current = [fresh(options[0])], []
+    while iterators:
+        for x in iterators[-1]:
+            if len(iterators) > last:
+                current.append(x)
+                yield tuple(current)
+                current.pop()
+            else:
+                current.append(x)
+                iterators.append(fresh(options[len(iterators)]))
+                break
+        else:
+            iterators.pop()
+            if current:
+                current.pop()
 
 
 def map_tree(tree: Tree[CategoryMeta], f: Callable[[CategoryMeta], T]) -> Tree[T]:
@@ -123,4 +918,48 @@ def map_tree(tree: Tree[CategoryMeta], f: Callable[[CategoryMeta], T]) -> Tree[T
 
 
 def get_depth(tree: AbsTree) -> int:
-    return 0 if isinstance(tree, CategoryMeta) else 1 + max([get_depth(c) for c in tree[1]])
\ No newline at end of file
+    return 0 if isinstance(tree, CategoryMeta) else 1 + max([get_depth(c) for c in tree[1]])
+
+
+class Node:
+    # hash-consed tree node: structurally equal trees are the same object, so equality is identity
+    __slots__ = ('label', 'children', 'hash', '__weakref__')
+    table: WeakValueDictionary = WeakValueDictionary()
+
+    label:      object
+    children:   tuple['Node', ...]
+    hash:       int
+
+    def __new__(cls, label: object, children: tuple['Node', ...] = ()) -> 'Node':
+        key = (label, children)
+        if (node := cls.table.get(key)) is not None:
+            return node
+        node = super().__new__(cls)
+        node.label, node.children, node.hash = label, children, hash(key)
+        cls.table[key] = node
+        return node
+
+    def __hash__(self) -> int:
+        return self.hash
+
+    def __eq__(self, other: object) -> bool:
+        return self is other
+
+    def __repr__(self) -> str:
+        if not self.children:
+            return repr(self.label)
+        children = ', '.join(map(repr, self.children)) + (',' if len(self.children) == 1 else '')
+        return f'({self.label!r}, ({children}))'
+
+    def __reduce__(self):
+        return Node, (self.label, self.children)
+
+
+def to_node(tree: Tree[T]) -> Node:
+    if isinstance(tree, tuple) and len(tree) == 2:
+        return Node(tree[0], tuple(map(to_node, tree[1])))
+    return Node(tree)
+
+
+def from_node(node: Node) -> Tree:
+    return (node.label, tuple(map(from_node, node.children))) if node.children else node.label